@@ -0,0 +1,165 @@
+import atexit
+import logging
+import queue
+import re
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from config import (USE_TELEGRAM_BOT, TELEGRAM_BOT_TOKEN, TELEGRAM_BOT_CHAT_ID, ALERT_WINDOW, ALERT_MAX_PER_HOUR,
+                    LOG_QUEUE_SIZE, ALERT_STUB, ALERT_STUB_FILE)
+
+QUOTED = re.compile(r'"([^"]*)"')
+# Telegram rejects longer messages.
+MAX_MESSAGE_LENGTH = 4000
+MAX_SUBJECTS = 20
+
+listener = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Logging must never block the caller, so records are dropped when the queue is full.
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StubSender:
+    def __init__(self, path=ALERT_STUB_FILE):
+        self.path = path
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(text)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(f'--- {time.strftime("%Y-%m-%d %H:%M:%S")}\n{text}\n')
+
+
+class TelegramSender:
+    def __init__(self, token=TELEGRAM_BOT_TOKEN, chat_id=TELEGRAM_BOT_CHAT_ID):
+        from tg_handler import TelegramLoggingHandler
+        self.handler = TelegramLoggingHandler(token, chat_id)
+
+    def send(self, text):
+        self.handler.emit(logging.makeLogRecord({'msg': text, 'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+
+
+class AlertHandler(logging.Handler):
+    # Collects records in the listener thread; a separate thread sends one digest per window.
+    def __init__(self, sender, window=ALERT_WINDOW, max_per_hour=ALERT_MAX_PER_HOUR):
+        super().__init__(logging.WARNING)
+        self.sender = sender
+        self.window = window
+        self.max_per_hour = max_per_hour
+        self.groups = {}
+        self.groups_lock = threading.Lock()
+        self.sent_times = []
+        self.suppressed = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='alerts', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        message = record.getMessage().split('\n', 1)[0]
+        key = (record.levelname, QUOTED.sub('"…"', message))
+        with self.groups_lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {'message': message, 'count': 0, 'subjects': []}
+            group['count'] += 1
+            subject = '/'.join(QUOTED.findall(message))
+            if subject and subject not in group['subjects']:
+                group['subjects'].append(subject)
+
+    def format_digest(self, groups):
+        lines = []
+        for (levelname, template), group in groups.items():
+            if group['count'] == 1:
+                lines.append(f'{levelname}: {group["message"]}')
+                continue
+            subjects = group['subjects']
+            line = f'{levelname} ×{group["count"]}: {template}'
+            if subjects:
+                line += f'\nAffected ({len(subjects)}): ' + ', '.join(subjects[:MAX_SUBJECTS])
+                if len(subjects) > MAX_SUBJECTS:
+                    line += f' and {len(subjects) - MAX_SUBJECTS} more'
+            lines.append(line)
+        text = '\n'.join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + '…'
+        return text
+
+    def send_digest(self):
+        with self.groups_lock:
+            groups, self.groups = self.groups, {}
+        if not groups:
+            return
+        now = time.monotonic()
+        self.sent_times = [sent for sent in self.sent_times if sent > now - 3600]
+        if len(self.sent_times) >= self.max_per_hour:
+            self.suppressed += sum(group['count'] for group in groups.values())
+            return
+        text = self.format_digest(groups)
+        if self.suppressed:
+            text += f'\n{self.suppressed} more messages were suppressed by the rate limit.'
+            self.suppressed = 0
+        self.sent_times.append(now)
+        try:
+            self.sender.send(text)
+        except Exception as e:
+            # Reporting through logging would feed the failure back into this handler.
+            print(f'Failed to send an alert: {e}', file=sys.stderr)
+
+    def run(self):
+        while not self.stopped.wait(self.window):
+            self.send_digest()
+
+    def close(self):
+        self.stopped.set()
+        self.send_digest()
+        super().close()
+
+
+def get_sender():
+    if ALERT_STUB:
+        return StubSender()
+    if USE_TELEGRAM_BOT:
+        return TelegramSender()
+    return None
+
+
+def setup_logging(loggers, handlers):
+    # All handlers run in the listener thread, callers only put the record on a queue.
+    global listener
+    sender = get_sender()
+    if sender is not None:
+        handlers = list(handlers) + [AlertHandler(sender)]
+    if not handlers:
+        return None
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    for logger in loggers:
+        logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+    return queue_handler
+
+
+def stop_logging():
+    # Sends whatever is still waiting for the end of the aggregation window.
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
@@ -1,34 +1,53 @@
+import csv
 import datetime
 import logging
 import os
 import shutil
-import zipfile
-from io import BytesIO
+import threading
+import time
 from logging.handlers import RotatingFileHandler
-from tg_handler import TelegramLoggingHandler
 
 import pytz
-from PIL import Image
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.base import JobLookupError
-from flask import (Flask, render_template, request, redirect, abort,
-                   flash, send_from_directory, send_file, url_for, jsonify)
+from flask import (Flask, Response, render_template, request, redirect, abort,
+                   flash, send_from_directory, send_file, url_for, jsonify, stream_with_context)
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from werkzeug.datastructures import ContentRange
+from wtforms import ValidationError
+
+import alerts
+import bulk
+import capture_jobs
+import catalog
+import contact_sheets
+import change_detection
+import metrics
+import preview
+import retention
+import storage
+import timelapse
+from archive import ZipArchive, get_archive_key
+from pipeline import encode_preview_from_image
+import thumbnails
+from capture import close_session, check_capture_options
 from config import *
 from forms import AddStreamForm, EditStreamForm, LoginForm
-from functions import (get_stream, load_state, save_state,
-                       get_index_context, save_image_from_stream,
-                       load_scheduler, add_scheduler_job,
-                       get_folder_by_stream_name, check_disk_space,
-                       delete_archive, delete_old_archives, VideoCaptureException,
-                       check_stream_and_space_job)
+from registry import streams
+from worker import get_owner
+from functions import (get_stream,
+                       get_index_context,
+                       sync_scheduler, create_scheduler, get_scheduler_context,
+                       get_folder_by_stream_name, parse_datetime_arg, get_pipeline_stats,
+                       check_stream_and_space_job, refresh_stream_info, drop_stream_info,
+                       get_files_page)
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 login_manager = LoginManager(app)
-scheduler = BackgroundScheduler()
+scheduler = create_scheduler()
 scheduler.start()
+scheduled_streams = {}
+scheduled_streams_lock = threading.Lock()
 
 
 class User(UserMixin):
@@ -37,6 +56,27 @@ class User(UserMixin):
         self.password = password
 
 
+def sync_jobs():
+    # In worker mode captures run in worker.py processes, the web process only keeps the registry.
+    if not WORKER_MODE:
+        with scheduled_streams_lock:
+            sync_scheduler(scheduler, streams, scheduled_streams)
+
+
+def reload_streams():
+    if streams.reload_if_changed():
+        sync_jobs()
+
+
+def reset_stream(stream_name):
+    # Drops everything cached for a stream that was edited, replaced by an import or deleted.
+    close_session(stream_name)
+    drop_stream_info(stream_name)
+    preview.drop(stream_name)
+    capture_jobs.drop_stream(stream_name)
+    change_detection.reset_state(stream_name)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     user_data = USERS.get(user_id)
@@ -101,7 +141,8 @@ def index():
                            streams=get_index_context(),
                            form=AddStreamForm(),
                            free_space=free_space,
-                           total_space=total_space)
+                           total_space=total_space,
+                           pipeline=get_pipeline_stats())
 
 
 @app.route('/add_stream', methods=['POST'])
@@ -111,9 +152,8 @@ def add_stream():
     if form.validate_on_submit():
         data = form.data
         data.pop('csrf_token')
-        RTSP_STREAMS.append(data)
-        save_state()
-        add_scheduler_job(scheduler, data)
+        streams.add(data)
+        sync_jobs()
         app.logger.info(f'Added new stream: "{data["name"]}" (URL: {data["url"]}, Interval: {data["interval"]} min)')
         flash(f'Stream "{data["name"]}" successfully added.', 'success')
         return redirect('/')
@@ -131,18 +171,18 @@ def edit_stream(stream_name):
         form = EditStreamForm(data=stream)
         return render_template('edit_page.html', stream=stream, form=form)
     else:
-        form = EditStreamForm()
+        form = EditStreamForm(stream=stream)
         if form.validate_on_submit():
             data = form.data
             data.pop('csrf_token')
-            stream.update(data)
             try:
-                scheduler.remove_job(stream_name)
-            except JobLookupError:
-                app.logger.warning(f'Failed to find job for "{stream_name}" while editing.')
-            add_scheduler_job(scheduler, stream)
+                streams.update(stream_name, data)
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return render_template('edit_page.html', stream=stream, form=form)
+            reset_stream(stream_name)
+            sync_jobs()
             app.logger.info(f'Edited stream: "{stream_name}"')
-            save_state()
             flash(f'Stream "{stream_name}" successfully update.', 'success')
             return redirect('/')
         return render_template('edit_page.html', stream=stream, form=form)
@@ -155,104 +195,392 @@ def delete_stream():
     stream = get_stream(stream_name)
     if not stream:
         abort(404)
-    scheduler.remove_job(stream_name)
-    RTSP_STREAMS.remove(stream)
+    reset_stream(stream_name)
+    streams.remove(stream_name)
+    sync_jobs()
     app.logger.info(f'Deleted stream: "{stream_name}"')
-    save_state()
     flash(f'Stream "{stream_name}" successfully delete.', 'success')
     return jsonify(status=True)
 
 
+@app.route('/streams/export')
+@login_required
+def export_streams():
+    data_format = 'csv' if request.args.get('format') == 'csv' else 'json'
+    return Response(bulk.export_streams(data_format),
+                    mimetype='text/csv' if data_format == 'csv' else 'application/json',
+                    headers={'Content-Disposition': f'attachment; filename="streams.{data_format}"'})
+
+
+@app.route('/streams/import', methods=['POST'])
+@login_required
+def import_streams():
+    upload = request.files.get('file')
+    # Not a FlaskForm, so the token is checked here; HTTP clients send it in the X-CSRFToken header.
+    try:
+        validate_csrf(request.form.get('csrf_token') or request.headers.get('X-CSRFToken'))
+    except ValidationError as e:
+        if upload is not None:
+            flash(f'Import failed: {e}', 'danger')
+            return redirect('/')
+        return jsonify(error=str(e)), 400
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig')
+        data_format = 'csv' if upload.filename.lower().endswith('.csv') else 'json'
+    else:
+        text = request.get_data(as_text=True)
+        data_format = 'csv' if request.mimetype == 'text/csv' else 'json'
+    data_format = request.args.get('format', data_format)
+    try:
+        rows = bulk.parse_rows(text, data_format)
+    except (ValueError, csv.Error) as e:
+        if upload is not None:
+            flash(f'Failed to parse the {data_format.upper()} file: {e}', 'danger')
+            return redirect('/')
+        return jsonify(error=f'Failed to parse the {data_format.upper()} data: {e}'), 400
+    report = bulk.import_streams(rows, update_existing=request.values.get('update') == '1',
+                                 dry_run=request.values.get('dry_run') == '1')
+    if report['applied']:
+        for stream_name in report['updated']:
+            reset_stream(stream_name)
+        sync_jobs()
+        app.logger.info(f'Imported streams: {len(report["added"])} added, {len(report["updated"])} updated.')
+    if upload is None:
+        return jsonify(report), 400 if report['errors'] else 200
+    if report['errors']:
+        for error in report['errors'][:10]:
+            flash(f'Row {error["row"]} ({error["name"]}): {"; ".join(error["errors"])}', 'danger')
+        flash(f'Nothing was imported, {len(report["errors"])} rows have errors.', 'danger')
+    else:
+        flash(f'{len(report["added"])} streams added, {len(report["updated"])} updated.', 'success')
+    return redirect('/')
+
+
 @app.route('/save_image/<stream_name>')
 @login_required
 def save_image_route(stream_name):
     stream = get_stream(stream_name)
+    if not stream:
+        abort(404)
     try:
-        save_result = save_image_from_stream(stream)
-        if save_result:
-            app.logger.debug(f'Image from "{stream_name}" successfully saved.')
-            flash(f'Image from "{stream_name}" successfully saved.', 'success')
-        else:
-            app.logger.error(f'Image from "{stream_name}" wasn\'t saved. '
-                             f'Because the stream has disabled saving '
-                             f'images or the set time for the stream has expired.')
-            flash(f'Image from "{stream_name}" wasn\'t saved. '
-                  f'Because the stream has disabled saving '
-                  f'images or the set time for the stream has expired.', 'warning')
-    except (VideoCaptureException, ValueError) as e:
-        app.logger.error(e)
-        flash(str(e), 'danger')
+        job = capture_jobs.request_capture(stream)
+    except capture_jobs.CaptureBusyError as e:
+        if request.args.get('format') == 'json':
+            return jsonify(error=str(e)), 503
+        flash(str(e), 'warning')
+        return redirect('/')
+    if request.args.get('format') == 'json':
+        return jsonify(job), 202
+    return redirect(url_for('capture_status', job_id=job['id']))
+
+
+@app.route('/capture/<job_id>')
+@login_required
+def capture_status(job_id):
+    job = capture_jobs.get_job(job_id)
+    if not job:
+        abort(404)
+    if request.args.get('format') == 'json':
+        return jsonify(job)
+    return render_template('capture.html', job=job)
+
+
+@app.route('/refresh_info/<stream_name>')
+@login_required
+def refresh_info(stream_name):
+    stream = get_stream(stream_name)
+    if not stream:
+        abort(404)
+    scheduler.add_job(refresh_stream_info, args=[stream], id=f'{stream_name}_refresh_info', replace_existing=True)
+    flash(f'Stream info for "{stream_name}" will be refreshed in a moment.', 'info')
     return redirect('/')
 
 
+@app.route('/scheduler')
+@login_required
+def scheduler_view():
+    jobs = get_scheduler_context(scheduler)
+    workers = []
+    if WORKER_MODE:
+        workers = streams.get_workers(time.time() - WORKER_TIMEOUT)
+        for job in jobs:
+            job['worker'] = get_owner(job['name'], workers) if workers else None
+    lags = [job['lag'] for job in jobs if job['lag'] is not None]
+    return render_template('scheduler.html', jobs=jobs, workers=workers, worker_mode=WORKER_MODE,
+                           max_lag=max(lags) if lags else None,
+                           mean_lag=sum(lags) / len(lags) if lags else None,
+                           missed=sum(job['missed'] for job in jobs))
+
+
+@app.route('/metrics')
+def metrics_view():
+    if not current_user.is_authenticated:
+        auth = request.authorization
+        user_data = USERS.get(auth.username) if auth and auth.username else None
+        if not user_data or user_data['password'] != auth.password:
+            return Response('Authentication required', 401, {'WWW-Authenticate': 'Basic realm="metrics"'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/<stream_name>/list_files')
 @login_required
 def list_files(stream_name):
-    folder = get_folder_by_stream_name(stream_name)
-    folder_size = 0
-    for file in os.scandir(folder):
-        folder_size += os.path.getsize(file)
-    files = os.scandir(folder)
-    files = sorted(files, key=lambda e: e.name)
-    return render_template('list_files.html', files=files, stream_name=stream_name, folder_size=folder_size)
+    if not get_stream(stream_name):
+        abort(404)
+    folder_size = catalog.get_usage(stream_name)['size']
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    files, next_after = get_files_page(stream_name, request.args.get('after'), start, end, FILES_PAGE_SIZE)
+    return render_template('list_files.html', files=files, stream_name=stream_name, folder_size=folder_size,
+                           next_after=next_after, start=start, end=end, csrf_token=generate_csrf(),
+                           timelapse_fps=TIMELAPSE_FPS)
+
+
+@app.route('/<stream_name>/files.json')
+@login_required
+def list_files_json(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
+    limit = min(request.args.get('limit', FILES_PAGE_SIZE, type=int), FILES_PAGE_SIZE * 10)
+    files, next_after = get_files_page(stream_name, request.args.get('after'), request.args.get('start'),
+                                       request.args.get('end'), max(limit, 1))
+    return jsonify(files=[dict(file) for file in files], next_after=next_after)
+
+
+def cache_image(response):
+    # Saved images and their thumbnails never change, browsers don't even have to revalidate them.
+    response.cache_control.no_cache = None
+    response.cache_control.public = None
+    response.cache_control.private = True
+    response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def get_saved_frame(stream_name):
+    # Nothing buffered by this process yet, show the newest saved image instead.
+    image = catalog.get_latest_image(stream_name)
+    if image is None:
+        return None
+    try:
+        data = storage.read_image(stream_name, image['filename'])
+    except OSError:
+        return None
+    if os.path.splitext(image['filename'])[1].lower() not in ('.jpg', '.jpeg'):
+        data = encode_preview_from_image(data)
+        if data is None:
+            return None
+    return image['timestamp'], data
+
+
+@app.route('/<stream_name>/latest.jpg')
+@login_required
+def latest_frame(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
+    preview.mark_viewed(stream_name)
+    frame = preview.get_frame(stream_name, request.args.get('back', 0, type=int)) or get_saved_frame(stream_name)
+    if frame is None:
+        abort(404)
+    timestamp, data = frame
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(f'{stream_name}-{timestamp}')
+    response.last_modified = timestamp
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/<stream_name>/preview')
+@login_required
+def preview_stream(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
+    preview.mark_viewed(stream_name)
+    frame = preview.get_latest(stream_name) or get_saved_frame(stream_name)
+    if frame is None:
+        abort(404)
+    try:
+        frames = preview.iter_mjpeg(stream_name, frame)
+    except preview.TooManyViewersError as e:
+        return str(e), 503
+    response = Response(frames, mimetype=f'multipart/x-mixed-replace; boundary={preview.BOUNDARY}')
+    response.cache_control.no_store = True
+    return response
+
+
+def get_contact_sheet_args():
+    try:
+        day = datetime.date.fromisoformat(request.args['day'])
+        hour = request.args.get('hour', type=int) if request.args.get('hour') else None
+    except (KeyError, ValueError):
+        abort(400)
+    if hour is not None and not 0 <= hour <= 23:
+        abort(400)
+    return day, hour
+
+
+@app.route('/<stream_name>/contact_sheet')
+@login_required
+def contact_sheet(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
+    day, hour = get_contact_sheet_args()
+    mapping = contact_sheets.get_mapping(stream_name, day, hour)
+    if request.args.get('format') == 'json':
+        return jsonify(mapping)
+    return render_template('contact_sheet.html', stream_name=stream_name, day=day, hour=hour, mapping=mapping)
+
+
+@app.route('/<stream_name>/contact_sheet.jpg')
+@login_required
+def contact_sheet_image(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
+    day, hour = get_contact_sheet_args()
+    try:
+        path, _ = contact_sheets.get_sheet(stream_name, day, hour)
+    except OSError as e:
+        app.logger.error(e)
+        abort(500)
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype='image/jpeg')
 
 
 @app.route('/<stream_name>/<filename>')
 @login_required
 def download_file(stream_name, filename):
-    return send_from_directory(get_folder_by_stream_name(stream_name), filename, as_attachment=True)
+    if not get_stream(stream_name):
+        abort(404)
+    filename = os.path.basename(filename)
+    attachment = request.args.get('inline') != '1'
+    image = catalog.get_image(stream_name, filename)
+    path = storage.get_image_path(stream_name, filename) if image is None or not image['pack'] else None
+    if path is not None:
+        return cache_image(send_from_directory(os.path.abspath(os.path.dirname(path)), filename,
+                                               as_attachment=attachment))
+    try:
+        file = storage.open_image(stream_name, filename)
+    except OSError:
+        abort(404)
+    etag = f'{image["timestamp"]}-{image["size"]}' if image else False
+    return cache_image(send_file(file, as_attachment=attachment, download_name=filename, etag=etag,
+                                 last_modified=image['timestamp'] if image else None))
 
 
 @app.route('/<stream_name>/download_all')
 @login_required
 def download_all(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
     app.logger.debug(f'The command to download the "{stream_name}" stream image archive has been launched.')
-
-    job_name = f'{stream_name}_delete_archive'
+    start = parse_datetime_arg(request.args.get('start'))
+    end = parse_datetime_arg(request.args.get('end'))
+    limit = request.args.get('max_files', type=int)
+
+    def measure(chunks):
+        with metrics.archive_seconds.time():
+            for chunk in chunks:
+                metrics.archive_bytes_total.inc(amount=len(chunk))
+                yield chunk
+
+    # The same selection always produces the same bytes, so the ETag and ranges stay valid between requests.
+    stats = catalog.get_selection_stats(stream_name, start, end, limit)
+    key = get_archive_key(stream_name, start, end, limit, *stats)
+    response = Response(mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="{stream_name}.zip"'})
+    response.set_etag(key)
+    response.accept_ranges = 'bytes'
+    if key in request.if_none_match:
+        return response.make_conditional(request)
+    count, data_size, _, last_filename, _, name_size = stats
+
+    def list_entries():
+        # Bounded by the last file name so images saved during the download don't shift the layout.
+        for image in catalog.list_images(stream_name, start=start, end=end, limit=limit, through=last_filename):
+            yield (image['filename'], image['timestamp'], image['size'], image['crc'],
+                   lambda filename=image['filename']: storage.open_image(stream_name, filename))
+
+    archive = ZipArchive(count, data_size, name_size, list_entries)
+    first, last = 0, archive.size
+    if request.range and request.if_range.date is None and request.if_range.etag in (None, key):
+        bounds = request.range.range_for_length(archive.size)
+        if bounds is None:
+            response.status_code = 416
+            response.content_range = ContentRange('bytes', None, None, archive.size)
+            return response
+        first, last = bounds
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', first, last, archive.size)
+    response.response = stream_with_context(measure(archive.iter_bytes(first, last)))
+    response.content_length = last - first
+    return response.make_conditional(request)
+
+
+@app.route('/<stream_name>/timelapse', methods=['POST'])
+@login_required
+def create_timelapse(stream_name):
+    if not get_stream(stream_name):
+        abort(404)
     try:
-        scheduler.remove_job(job_name)
-    except JobLookupError:
-        pass
-
-    zip_filename = f'{stream_name}.zip'
-    image_folder = get_folder_by_stream_name(stream_name)
-    temp_zip_path = 'temp'
-    os.makedirs(temp_zip_path, exist_ok=True)
-    temp_zip_filename = os.path.join(temp_zip_path, zip_filename)
-    folder = get_folder_by_stream_name(stream_name)
-    folder_size = 0
-    for file in os.scandir(folder):
-        folder_size += os.path.getsize(file)
-    check_disk_space(temp_zip_path, required_space=((folder_size / 1024 ** 3) + 1))
-
-    with zipfile.ZipFile(temp_zip_filename, 'w') as zipf:
-        for file in os.listdir(image_folder):
-            file_path = os.path.join(image_folder, file)
-            zipf.write(file_path, file)
-    app.logger.info(f'The archive for "{stream_name}" has been successfully created.')
-    scheduler.add_job(
-        delete_archive,
-        'date',
-        [stream_name],
-        run_date=(datetime.datetime.now()+datetime.timedelta(minutes=DELETE_ARCHIVES_DELAY)),
-        name=job_name
-    )
-    return send_from_directory(temp_zip_path, zip_filename)
+        validate_csrf(request.form.get('csrf_token'))
+    except ValidationError as e:
+        flash(f'Time-lapse failed: {e}', 'danger')
+        return redirect(url_for('list_files', stream_name=stream_name))
+    try:
+        start_date = datetime.date.fromisoformat(request.form['start_date'])
+        end_date = datetime.date.fromisoformat(request.form.get('end_date') or request.form['start_date'])
+        fps = request.form.get('fps', TIMELAPSE_FPS, type=int)
+    except (KeyError, ValueError):
+        flash('Invalid time-lapse period.', 'danger')
+        return redirect(url_for('list_files', stream_name=stream_name))
+    if end_date < start_date or not 1 <= fps <= 120:
+        flash('Invalid time-lapse period.', 'danger')
+        return redirect(url_for('list_files', stream_name=stream_name))
+    job = timelapse.start_job(stream_name, start_date, end_date, fps)
+    app.logger.debug(f'Time-lapse for "{stream_name}" from {start_date} to {end_date} has been queued.')
+    return redirect(url_for('timelapse_status', job_id=job['id']))
+
+
+@app.route('/timelapse/<job_id>')
+@login_required
+def timelapse_status(job_id):
+    job = timelapse.get_job(job_id)
+    if not job:
+        abort(404)
+    if request.args.get('format') == 'json':
+        data = {key: value for key, value in job.items() if key != 'path'}
+        data.update(start_date=job['start_date'].isoformat(), end_date=job['end_date'].isoformat())
+        return jsonify(data)
+    return render_template('timelapse.html', job=job)
+
+
+@app.route('/timelapse/<job_id>/download')
+@login_required
+def timelapse_download(job_id):
+    job = timelapse.get_job(job_id)
+    if not job or job['status'] != 'done':
+        abort(404)
+    return send_file(os.path.abspath(job['path']), as_attachment=True,
+                     download_name=f'{job["stream"]}_{job["start_date"]}_{job["end_date"]}.mp4')
 
 
 @app.route('/<stream_name>/thumbnail/<filename>')
 @login_required
 def thumbnail(stream_name, filename):
-    file_path = os.path.join(get_folder_by_stream_name(stream_name), filename)
-    try:
-        img_io = BytesIO()
-        image = Image.open(file_path)
-        image.thumbnail((80, 80))
-        image.save(img_io, 'JPEG', quality=70)
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/jpeg')
-    except (OSError, IOError):
-        return 'Ошибка обработки изображения', 500
+    if not get_stream(stream_name):
+        abort(404)
+    filename = os.path.basename(filename)
+    thumbnail_path = thumbnails.get_thumbnail_path(stream_name, filename)
+    if not os.path.exists(thumbnail_path):
+        try:
+            with metrics.thumbnail_seconds.time('miss'), storage.open_image(stream_name, filename) as source:
+                thumbnails.create_thumbnail(stream_name, filename, source)
+        except (OSError, IOError):
+            return 'Ошибка обработки изображения', 500
+    else:
+        metrics.thumbnail_seconds.observe(0, 'hit')
+    return cache_image(send_file(os.path.abspath(thumbnail_path), mimetype='image/jpeg'))
 
 
 @app.route('/<stream_name>/clear_folder')
@@ -269,6 +597,11 @@ def clear_folder(stream_name):
                 shutil.rmtree(file_path, ignore_errors=True)
         except (OSError, IsADirectoryError, WindowsError) as e:
             app.logger.warning(f'Folder for "{stream_name}" wasn\'t cleared due to {e}.')
+    catalog.delete_stream_images(stream_name)
+    retention.reset_usage(stream_name)
+    thumbnails.delete_thumbnails(stream_name)
+    contact_sheets.delete_sheets(stream_name)
+    timelapse.delete_segments(stream_name)
     app.logger.warning(f'The command to delete the "{stream_name}" stream directory has been executed.')
     flash(f'Folder for "{stream_name}" successfully cleared.', 'success')
     return redirect(url_for('list_files', stream_name=stream_name))
@@ -279,20 +612,21 @@ def create_app():
     handler = RotatingFileHandler('app.log', maxBytes=1024 * 1024, backupCount=5)
     handler.setFormatter(formatter)
     handler.setLevel(logging.INFO)
-    if USE_TELEGRAM_BOT:
-        tg_handler = TelegramLoggingHandler(TELEGRAM_BOT_TOKEN, TELEGRAM_BOT_CHAT_ID)
-        tg_handler.setFormatter(formatter)
-        tg_handler.setLevel(logging.WARNING)
-        logging.getLogger('apscheduler').addHandler(tg_handler)
-        app.logger.addHandler(tg_handler)
-
-    logging.getLogger('apscheduler').addHandler(handler)
-    app.logger.addHandler(handler)
-
-    delete_old_archives()
-    load_state()
-    scheduler.add_job(check_stream_and_space_job, 'interval', minutes=5, id='check')
-    load_scheduler(scheduler)
+    # File writes and alerts happen in a background thread, so logging never slows down capture jobs.
+    alerts.setup_logging([logging.getLogger('apscheduler'), app.logger], [handler])
+
+    if not os.path.exists(CATALOG_DB):
+        scheduler.add_job(catalog.rebuild_all, id='catalog_rebuild')
+    streams.load()
+    check_capture_options(streams)
+    scheduler.add_job(check_stream_and_space_job, 'interval', minutes=5, id='check',
+                      next_run_time=datetime.datetime.now())
+    scheduler.add_job(thumbnails.evict_thumbnails, 'interval', minutes=30, id='thumbnails_evict')
+    if STORAGE_PACK_CLOSED_DAYS:
+        scheduler.add_job(storage.pack_closed_days, 'cron', hour=STORAGE_PACK_HOUR, id='storage_pack')
+    sync_jobs()
+    scheduler.add_job(reload_streams, 'interval', seconds=STATE_RELOAD_INTERVAL, id='streams_reload')
+    retention.start()
     app.logger.warning('The app is running.')
     return app
 
@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import struct
+import time
+import zlib
+
+logger = logging.getLogger('app')
+
+CHUNK_SIZE = 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+# Extra field holding the real offset of an entry once offsets can pass 4 GB.
+ZIP64_OFFSET_EXTRA = struct.Struct('<2HQ')
+EXTERNAL_ATTR = 0o644 << 16
+UTF8_FLAG = 0x800
+
+
+def get_archive_key(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def get_dos_time(timestamp):
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    if year < 1980:
+        return 0, (1 << 5) | 1
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class ZipEntry:
+    def __init__(self, arcname, timestamp, size, crc, open_function, offset):
+        if size >= ZIP64_LIMIT:
+            raise ValueError(f'"{arcname}" is too large for an archive entry.')
+        self.name = arcname.encode('utf-8')
+        self.flags = 0 if arcname.isascii() else UTF8_FLAG
+        self.dos_time, self.dos_date = get_dos_time(timestamp)
+        self.size = size
+        self.crc = crc
+        self.open_function = open_function
+        self.offset = offset
+        self.end = offset + LOCAL_HEADER.size + len(self.name) + size
+
+    def read(self):
+        with self.open_function() as source:
+            data = source.read()
+        if len(data) != self.size:
+            raise OSError(f'"{self.name.decode()}" has {len(data)} bytes, the catalog lists {self.size}.')
+        if self.crc is None:
+            self.crc = zlib.crc32(data)
+        return data
+
+    def get_crc(self):
+        # Only images cataloged before the crc column existed and not yet reconciled are read for it.
+        if self.crc is None:
+            self.read()
+        return self.crc
+
+    def local_header(self):
+        return LOCAL_HEADER.pack(b'PK\x03\x04', 20, 0, self.flags, 0, self.dos_time, self.dos_date,
+                                 self.get_crc(), self.size, self.size, len(self.name), 0) + self.name
+
+    def central_header(self, zip64_offsets):
+        extra = ZIP64_OFFSET_EXTRA.pack(1, 8, self.offset) if zip64_offsets else b''
+        version = 45 if zip64_offsets else 20
+        return CENTRAL_HEADER.pack(b'PK\x01\x02', version, 3, version, 0, self.flags, 0, self.dos_time,
+                                   self.dos_date, self.get_crc(), self.size, self.size, len(self.name), len(extra),
+                                   0, 0, 0, EXTERNAL_ATTR, ZIP64_LIMIT if zip64_offsets else self.offset
+                                   ) + self.name + extra
+
+
+class ZipArchive:
+    # Images are stored without compression and their CRCs are in the catalog, so the layout follows from
+    # the entry count, the name lengths and the sizes. The size is known without listing the entries,
+    # and a byte range only reads the images it covers.
+    def __init__(self, count, data_size, name_size, list_entries):
+        # list_entries() yields (arcname, timestamp, size, crc, open_function) in archive order on every call.
+        self.count = count
+        self.list_entries = list_entries
+        self.central_offset = count * LOCAL_HEADER.size + name_size + data_size
+        # With offsets past 4 GB every central header carries its offset in a ZIP64 extra field.
+        self.zip64_offsets = self.central_offset >= ZIP64_LIMIT
+        self.central_size = count * CENTRAL_HEADER.size + name_size
+        if self.zip64_offsets:
+            self.central_size += count * ZIP64_OFFSET_EXTRA.size
+        self.zip64 = self.zip64_offsets or count >= ZIP64_COUNT_LIMIT or self.central_size >= ZIP64_LIMIT
+        self.size = self.central_offset + self.central_size + END_RECORD.size
+        if self.zip64:
+            self.size += ZIP64_END_RECORD.size + ZIP64_LOCATOR.size
+
+    def iter_entries(self):
+        offset = 0
+        count = 0
+        for arcname, timestamp, size, crc, open_function in self.list_entries():
+            entry = ZipEntry(arcname, timestamp, size, crc, open_function, offset)
+            offset = entry.end
+            count += 1
+            if offset > self.central_offset or count > self.count:
+                raise OSError('The selection changed while the archive was sent.')
+            yield entry
+        if offset != self.central_offset:
+            raise OSError('The selection changed while the archive was sent.')
+
+    def end_records(self):
+        records = b''
+        if self.zip64:
+            zip64_offset = self.central_offset + self.central_size
+            records += ZIP64_END_RECORD.pack(b'PK\x06\x06', ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, self.count,
+                                             self.count, self.central_size, self.central_offset)
+            records += ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, zip64_offset, 1)
+        count = min(self.count, ZIP64_COUNT_LIMIT)
+        return records + END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, min(self.central_size, ZIP64_LIMIT),
+                                         min(self.central_offset, ZIP64_LIMIT), 0)
+
+    def iter_bytes(self, start=0, stop=None):
+        stop = self.size if stop is None else stop
+        if start < self.central_offset:
+            for entry in self.iter_entries():
+                if entry.end <= start:
+                    continue
+                if entry.offset >= stop:
+                    break
+                piece = memoryview(entry.local_header() + entry.read())[max(start - entry.offset, 0):
+                                                                        stop - entry.offset]
+                for position in range(0, len(piece), CHUNK_SIZE):
+                    yield bytes(piece[position:position + CHUNK_SIZE])
+        central_end = self.central_offset + self.central_size
+        if stop > self.central_offset and start < central_end:
+            chunks = []
+            buffered = 0
+            position = self.central_offset
+            header_size = CENTRAL_HEADER.size + (ZIP64_OFFSET_EXTRA.size if self.zip64_offsets else 0)
+            for entry in self.iter_entries():
+                length = header_size + len(entry.name)
+                if position + length > start:
+                    chunk = entry.central_header(self.zip64_offsets)[max(start - position, 0):stop - position]
+                    chunks.append(chunk)
+                    buffered += len(chunk)
+                    if buffered >= CHUNK_SIZE:
+                        yield b''.join(chunks)
+                        chunks = []
+                        buffered = 0
+                position += length
+                if position >= stop:
+                    break
+            if chunks:
+                yield b''.join(chunks)
+        if stop > central_end:
+            yield self.end_records()[max(start - central_end, 0):stop - central_end]
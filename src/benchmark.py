@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+# Every extension and quality flag combination that EditStreamForm can produce.
+ENCODE_CASES = [
+    ('.jpg', {}),
+    ('.jpg', {'use_flags': True, 'jpg_quality': 95}),
+    ('.jpg', {'use_flags': True, 'jpg_quality': 75}),
+    ('.jpg', {'use_flags': True, 'jpg_quality': 95, 'jpg_optimize': 1}),
+    ('.jp2', {}),
+    ('.jp2', {'use_flags': True, 'jp2_compression': 250}),
+    ('.webp', {}),
+    ('.webp', {'use_flags': True, 'webp_quality': 80}),
+    ('.png', {}),
+    ('.png', {'use_flags': True, 'png_compression': 1}),
+    ('.png', {'use_flags': True, 'png_compression': 9}),
+]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': statistics.mean(samples),
+        'median': statistics.median(samples),
+        'p95': samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+        'min': samples[0],
+        'max': samples[-1]
+    }
+
+
+def timed(function, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples), result
+
+
+def create_synthetic_video(path, width, height, fps, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError('Failed to create the synthetic video "{}".'.format(path))
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    rng = np.random.default_rng(0)
+    for i in range(frames):
+        frame = np.dstack([np.roll(gradient, i * 8, axis=1), np.roll(gradient, i * 4, axis=0), gradient])
+        frame = cv2.add(frame, rng.integers(0, 16, frame.shape, dtype=np.uint8))
+        cv2.putText(frame, str(i), (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5)
+        writer.write(frame)
+    writer.release()
+
+
+def bench_capture(source, repeat, stream=None):
+    from capture import open_stream
+
+    # The capture options of a stream (transport, timeouts, probe size) apply just like in the app.
+    stream = dict(stream or {}, url=source)
+
+    def open_source():
+        cap = open_stream(stream)
+        opened = cap.isOpened()
+        cap.release()
+        return opened
+
+    def first_frame():
+        cap = open_stream(stream)
+        ret, frame = cap.read()
+        cap.release()
+        return frame if ret else None
+
+    open_stats, _ = timed(open_source, repeat)
+    frame_stats, frame = timed(first_frame, repeat)
+    if frame is None:
+        raise RuntimeError('Failed to read a frame from "{}".'.format(source))
+    return {'open': open_stats, 'open_and_first_frame': frame_stats}, frame
+
+
+def bench_encode(frame, repeat, folder):
+    import storage
+    from functions import get_flags
+    from pipeline import encode_frame
+
+    results = []
+    height, width = frame.shape[:2]
+    resize_stats, _ = timed(lambda: cv2.resize(frame, (width // 2, height // 2)), repeat)
+    for extension, options in ENCODE_CASES:
+        flags = get_flags(options, extension)
+        # encode_frame also makes the thumbnail and preview, so its own stage timings are reported separately.
+        samples = {}
+        for _ in range(repeat):
+            data, _, _, _, _, timings = encode_frame(frame, extension, flags)
+            for stage, seconds in timings.items():
+                samples.setdefault(stage, []).append(seconds)
+        # The same path as the app: temp file, free space check, rename and fsync per DURABILITY.
+        write_stats, _ = timed(lambda: storage.write_image(folder, 'write_test' + extension, data), repeat)
+        storage.sync_folders(force=True)
+        results.append({'extension': extension, 'options': options, 'size': len(data),
+                        **{stage: summarize(values) for stage, values in samples.items()}, 'write': write_stats})
+    return {'resize_half': resize_stats, 'formats': results}
+
+
+def bench_sustained(source, streams, period, duration, extension):
+    from functions import create_scheduler, save_image_job, job_timing
+    from pipeline import get_pipeline_stats, encode_queue, write_queue
+
+    scheduler = create_scheduler()
+    before = get_pipeline_stats()
+    for i in range(streams):
+        stream = {'name': f'bench_{i}', 'url': source, 'interval': 1, 'extension': extension}
+        os.makedirs(os.path.join('images', stream['name']), exist_ok=True)
+        scheduler.add_job(save_image_job, 'interval', [stream], seconds=period, id=stream['name'])
+    started = time.perf_counter()
+    scheduler.start()
+    time.sleep(duration)
+    scheduler.shutdown(wait=True)
+    encode_queue.join()
+    write_queue.join()
+    elapsed = time.perf_counter() - started
+    after = get_pipeline_stats()
+    lags = [timing['lag'] for timing in job_timing.values() if timing.get('lag') is not None]
+    written = after['written'] - before['written']
+    return {
+        'streams': streams,
+        'period': period,
+        'duration': elapsed,
+        'written': written,
+        'dropped': after['dropped'] - before['dropped'],
+        'failed': after['failed'] - before['failed'],
+        'captures_per_second': written / elapsed,
+        'planned_per_second': streams / period,
+        'start_lag': summarize(lags) if lags else None
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    def walk(current, previous, path):
+        if isinstance(current, dict) and isinstance(previous, dict):
+            if 'median' in current and 'median' in previous:
+                if previous['median'] and current['median'] > previous['median'] * (1 + tolerance):
+                    regressions.append(f'{path}: {previous["median"]:.6f} -> {current["median"]:.6f} s')
+                return
+            for key in current:
+                if key in previous:
+                    walk(current[key], previous[key], f'{path}.{key}' if path else key)
+        elif isinstance(current, list) and isinstance(previous, list):
+            for i, (item, previous_item) in enumerate(zip(current, previous)):
+                walk(item, previous_item, f'{path}[{i}]')
+
+    walk(results, baseline, '')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark capture, encode and write throughput offline.')
+    parser.add_argument('--source', help='Video file or stream URL, a synthetic video is generated by default.')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--streams', type=int, default=20, help='Simulated streams for the sustained run.')
+    parser.add_argument('--period', type=float, default=2, help='Capture period of each simulated stream, s.')
+    parser.add_argument('--duration', type=float, default=30, help='Length of the sustained run, s, 0 to skip.')
+    parser.add_argument('--extension', default='.jpg', help='Extension used in the sustained run.')
+    parser.add_argument('--transport', choices=['tcp', 'udp'], help='RTSP transport of the capture benchmark.')
+    parser.add_argument('--probesize', type=int, help='FFmpeg probe size of the capture benchmark, bytes.')
+    parser.add_argument('--analyzeduration', type=int, help='FFmpeg analyze duration of the capture benchmark, ms.')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout.')
+    parser.add_argument('--baseline', help='Previous JSON results to compare medians against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline.')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from config import DURABILITY
+    with tempfile.TemporaryDirectory() as workdir:
+        # The app uses relative folders, so everything it writes ends up in the scratch directory.
+        os.chdir(workdir)
+        os.makedirs('images')
+        source = args.source
+        if not source:
+            source = os.path.join(workdir, 'synthetic.avi')
+            create_synthetic_video(source, args.width, args.height, 25, 100)
+        stream = {'capture_transport': args.transport, 'capture_probesize': args.probesize,
+                  'capture_analyzeduration': args.analyzeduration}
+        capture, frame = bench_capture(source, args.repeat, stream)
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'durability': DURABILITY
+            },
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+            'frame': {'width': frame.shape[1], 'height': frame.shape[0]},
+            'capture': capture,
+            'encode': bench_encode(frame, args.repeat, workdir)
+        }
+        if args.duration:
+            results['sustained'] = bench_sustained(source, args.streams, args.period, args.duration,
+                                                   args.extension)
+        os.chdir(os.path.dirname(workdir))
+
+    text = json.dumps(results, indent=4)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
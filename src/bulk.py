@@ -0,0 +1,154 @@
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+
+from werkzeug.datastructures import MultiDict
+from wtforms import BooleanField, TimeField
+
+from config import IMAGE_FOLDER
+from forms import EditStreamForm
+from registry import streams, dump_stream, load_with_datetime
+
+FIRST_COLUMNS = ['name', 'url', 'interval']
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+
+
+def parse_rows(text, data_format):
+    if data_format == 'csv':
+        return [{key: value for key, value in row.items() if key and value not in (None, '')}
+                for row in csv.DictReader(io.StringIO(text))]
+    rows = json.loads(text, object_pairs_hook=load_with_datetime)
+    if isinstance(rows, dict):
+        rows = rows.get('streams', [])
+    if not isinstance(rows, list):
+        raise ValueError('Expected a list of streams.')
+    return rows
+
+
+def to_formdata(form, data):
+    formdata = MultiDict()
+    for field in form:
+        value = data.get(field.name)
+        if value is None or field.name == 'csrf_token':
+            continue
+        if isinstance(field, BooleanField):
+            if value is True or str(value).lower() in TRUE_VALUES:
+                formdata[field.name] = 'y'
+        elif isinstance(field, TimeField):
+            if isinstance(value, str):
+                try:
+                    value = datetime.time.fromisoformat(value)
+                except ValueError:
+                    formdata[field.name] = value
+                    continue
+            formdata[field.name] = value.strftime('%H:%M')
+        else:
+            formdata[field.name] = str(value)
+    return formdata
+
+
+def validate_rows(rows, update_existing=False):
+    # One pass with set lookups; the image folders are listed once instead of checked per row.
+    defaults = EditStreamForm(meta={'csrf': False}, formdata=None).data
+    folders = set(os.listdir(IMAGE_FOLDER)) if os.path.isdir(IMAGE_FOLDER) else set()
+    added = []
+    updated = {}
+    errors = []
+    batch_names = set()
+    batch_urls = set()
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            errors.append({'row': number, 'name': None, 'errors': ['Expected an object.']})
+            continue
+        name = row.get('name')
+        existing = streams.get(name) if name else None
+        row_errors = []
+        if existing is not None and not update_existing:
+            row_errors.append(f'This name "{name}" already exists.')
+        elif existing is None and name in folders:
+            row_errors.append(f'Folder with name "{name}" already exists.')
+        if name and name in batch_names:
+            row_errors.append(f'The name "{name}" is repeated in the batch.')
+        url = row.get('url') or (existing or {}).get('url')
+        if url and url in batch_urls:
+            row_errors.append(f'The url "{url}" is repeated in the batch.')
+        batch_names.add(name)
+        batch_urls.add(url)
+
+        # The form checks that the url isn't taken by another stream.
+        form = EditStreamForm(meta={'csrf': False}, formdata=None, stream=existing)
+        form.process(to_formdata(form, {**defaults, **(existing or {}), **row}))
+        if not form.validate():
+            row_errors.extend(f'{field}: {message}' for field, messages in form.errors.items() for message in messages)
+        if row_errors:
+            errors.append({'row': number, 'name': name, 'errors': row_errors})
+            continue
+        data = form.data
+        data.pop('csrf_token', None)
+        if existing is not None:
+            updated[name] = data
+        else:
+            added.append(data)
+    return added, updated, errors
+
+
+def import_streams(rows, update_existing=False, dry_run=False):
+    added, updated, errors = validate_rows(rows, update_existing)
+    report = {'added': [stream['name'] for stream in added], 'updated': list(updated), 'errors': errors,
+              'applied': False}
+    # The batch is applied as a whole or not at all.
+    if not errors and not dry_run and (added or updated):
+        streams.apply_batch(added, updated)
+        report['applied'] = True
+    return report
+
+
+def export_streams(data_format):
+    if data_format == 'csv':
+        items = [json.loads(dump_stream(stream)) for stream in streams]
+        columns = {key for item in items for key in item}
+        fieldnames = FIRST_COLUMNS + sorted(columns - set(FIRST_COLUMNS))
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer.writeheader()
+        for item in items:
+            writer.writerow({key: str(value).lower() if isinstance(value, bool) else value
+                             for key, value in item.items()})
+        return output.getvalue()
+    return '[' + ',\n'.join(dump_stream(stream) for stream in streams) + ']\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import or export streams in bulk.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='Print all streams.')
+    export_parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    import_parser = subparsers.add_parser('import', help='Add streams from a JSON or CSV file.')
+    import_parser.add_argument('file', help='File to import, "-" for stdin.')
+    import_parser.add_argument('--format', choices=['json', 'csv'],
+                               help='Input format, guessed from the file extension by default.')
+    import_parser.add_argument('--update', action='store_true', help='Update streams that already exist.')
+    import_parser.add_argument('--dry-run', action='store_true', help='Only validate the file.')
+    args = parser.parse_args()
+
+    # The forms need an application context; a running web process picks the changes up by itself.
+    from app import app
+    with app.app_context():
+        streams.load()
+        if args.command == 'export':
+            sys.stdout.write(export_streams(args.format))
+        else:
+            data_format = args.format or ('csv' if args.file.lower().endswith('.csv') else 'json')
+            if args.file == '-':
+                text = sys.stdin.read()
+            else:
+                with open(args.file, encoding='utf-8-sig') as file:
+                    text = file.read()
+            result = import_streams(parse_rows(text, data_format), args.update, args.dry_run)
+            print(json.dumps(result, indent=4))
+            if result['errors']:
+                sys.exit(1)
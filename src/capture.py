@@ -0,0 +1,226 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+
+import metrics
+from config import (CAPTURE_SESSION_IDLE_TIMEOUT, CAPTURE_SESSION_RETRY_DELAY, CAPTURE_SESSION_MAX_RETRY_DELAY,
+                    CAPTURE_OPEN_TIMEOUT, CAPTURE_READ_TIMEOUT, CAPTURE_MIXED_OPTIONS_OPEN_TIMEOUT)
+
+logger = logging.getLogger('app')
+
+
+class VideoCaptureException(Exception):
+    pass
+
+
+# OpenCV reads the FFmpeg demuxer options from this variable on every open.
+FFMPEG_OPTIONS_VARIABLE = 'OPENCV_FFMPEG_CAPTURE_OPTIONS'
+
+DEFAULT_CAPTURE_OPTIONS = 'rtsp_transport;tcp'
+
+options_condition = threading.Condition()
+options_state = {'options': os.environ.get(FFMPEG_OPTIONS_VARIABLE), 'opening': 0, 'waiting': 0, 'mixed': False}
+
+
+@contextmanager
+def ffmpeg_options(options):
+    # The variable is process-wide: opens with the same options run in parallel, others take turns.
+    # Once an open with other options is waiting, new opens queue behind it so it isn't starved.
+    with options_condition:
+        if options_state['options'] != options or options_state['waiting']:
+            options_state['waiting'] += 1
+            options_condition.wait_for(lambda: options_state['opening'] == 0)
+            options_state['waiting'] -= 1
+            if options_state['options'] != options:
+                if options is None:
+                    os.environ.pop(FFMPEG_OPTIONS_VARIABLE, None)
+                else:
+                    os.environ[FFMPEG_OPTIONS_VARIABLE] = options
+                options_state['options'] = options
+        options_state['opening'] += 1
+    try:
+        yield
+    finally:
+        with options_condition:
+            options_state['opening'] -= 1
+            options_condition.notify_all()
+
+
+def get_capture_options(stream):
+    # OpenCV uses TCP when no options are set, keep that as the default transport.
+    options = {'rtsp_transport': stream.get('capture_transport') or 'tcp'}
+    if stream.get('capture_probesize'):
+        options['probesize'] = int(stream['capture_probesize'])
+    if stream.get('capture_analyzeduration') is not None:
+        options['analyzeduration'] = int(stream['capture_analyzeduration']) * 1000  # Microseconds
+    return '|'.join(f'{key};{value}' for key, value in options.items())
+
+
+def set_mixed_options():
+    with options_condition:
+        if options_state['mixed']:
+            return
+        options_state['mixed'] = True
+    logger.warning(f'Streams use different FFmpeg capture options, so their opens take turns. Opens without '
+                   f'an open timeout now give up after {CAPTURE_MIXED_OPTIONS_OPEN_TIMEOUT} s.')
+
+
+def check_capture_options(streams):
+    # Called at startup so the fallback timeout is announced before the first open.
+    if any(get_capture_options(stream) != DEFAULT_CAPTURE_OPTIONS for stream in streams):
+        set_mixed_options()
+
+
+def open_capture(url, open_timeout=None, read_timeout=None, options=None):
+    if options != DEFAULT_CAPTURE_OPTIONS:
+        set_mixed_options()
+    if not open_timeout and options_state['mixed']:
+        open_timeout = CAPTURE_MIXED_OPTIONS_OPEN_TIMEOUT
+    params = []
+    if open_timeout:
+        params.extend([cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(open_timeout * 1000)])
+    if read_timeout:
+        params.extend([cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(read_timeout * 1000)])
+    with ffmpeg_options(options):
+        if params:
+            return cv2.VideoCapture(url, cv2.CAP_FFMPEG, params)
+        return cv2.VideoCapture(url)
+
+
+def open_stream(stream, url=None, open_timeout=CAPTURE_OPEN_TIMEOUT, read_timeout=CAPTURE_READ_TIMEOUT):
+    return open_capture(url or stream['url'],
+                        stream.get('capture_open_timeout') or open_timeout,
+                        stream.get('capture_read_timeout') or read_timeout,
+                        get_capture_options(stream))
+
+
+def get_capture_settings(stream):
+    return (stream['url'], stream.get('capture_open_timeout'), stream.get('capture_read_timeout'),
+            get_capture_options(stream))
+
+
+class CaptureSession:
+    def __init__(self, stream):
+        self.name = stream['name']
+        self.stream = dict(stream)
+        self.settings = get_capture_settings(stream)
+        self.cap = None
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f'capture-session-{self.name}', daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        cap = open_stream(self.stream)
+        if cap.isOpened():
+            self.cap = cap
+            self.failures = 0
+            logger.debug(f'Capture session for "{self.name}" opened.')
+            return True
+        cap.release()
+        self._backoff()
+        return False
+
+    def _backoff(self):
+        self.failures += 1
+        delay = min(CAPTURE_SESSION_RETRY_DELAY * 2 ** (self.failures - 1), CAPTURE_SESSION_MAX_RETRY_DELAY)
+        self.retry_at = time.monotonic() + delay
+        logger.warning(f'Capture session for "{self.name}" failed, retrying in {delay} s.')
+
+    def _release(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    def _run(self):
+        # Keep grabbing (without decoding to BGR) so the FFmpeg buffer never goes stale
+        # and the next capture only needs a retrieve() of the freshest frame.
+        while not self.closed:
+            if time.monotonic() - self.last_used > CAPTURE_SESSION_IDLE_TIMEOUT:
+                logger.debug(f'Capture session for "{self.name}" closed after idle timeout.')
+                close_session(self.name, self)
+                break
+            if self.cap is None and time.monotonic() < self.retry_at:
+                time.sleep(min(1, self.retry_at - time.monotonic()))
+                continue
+            with self.lock:
+                if self.closed:
+                    break
+                if self.cap is None and not self._open():
+                    continue
+                if not self.cap.grab():
+                    self._release()
+                    self._backoff()
+
+    def read(self):
+        self.last_used = time.monotonic()
+        with self.lock:
+            if self.cap is None:
+                if time.monotonic() < self.retry_at or not self._open():
+                    return False, None
+                return self.cap.read()
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                ret, frame = self.cap.read()
+            if not ret:
+                self._release()
+                self._backoff()
+            return ret, frame
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self._release()
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(stream):
+    with sessions_lock:
+        session = sessions.get(stream['name'])
+        if session is None or session.closed or session.settings != get_capture_settings(stream):
+            if session is not None:
+                session.close()
+            session = CaptureSession(stream)
+            sessions[stream['name']] = session
+        return session
+
+
+def close_session(stream_name, session=None):
+    with sessions_lock:
+        current = sessions.get(stream_name)
+        if current is None or (session is not None and current is not session):
+            return
+        del sessions[stream_name]
+    current.close()
+
+
+def close_all_sessions():
+    for stream_name in list(sessions):
+        close_session(stream_name)
+
+
+def grab_frame(stream):
+    if stream.get('keep_open'):
+        with metrics.capture_stage_seconds.time('read'):
+            ret, frame = get_session(stream).read()
+    else:
+        with metrics.capture_stage_seconds.time('open'):
+            cap = open_stream(stream)
+        with metrics.capture_stage_seconds.time('read'):
+            ret, frame = cap.read()
+        cap.release()
+    if not ret:
+        metrics.capture_failures_total.inc('capture')
+        raise VideoCaptureException('Failed to capture frame from the video stream. The stream'
+                                    ' may not be available. Stream: "{}"'.format(stream['name']))
+    return frame
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from capture import VideoCaptureException
+from config import (MANUAL_CAPTURE_WORKERS, MANUAL_CAPTURE_MAX_PENDING, MANUAL_CAPTURE_COALESCE,
+                    MANUAL_CAPTURE_JOB_TTL, MANUAL_CAPTURE_SAVE_TIMEOUT)
+from functions import save_image_from_stream, DiskSpaceError
+from pipeline import PipelineFullError
+
+logger = logging.getLogger('app')
+
+jobs = {}
+latest_jobs = {}
+jobs_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=MANUAL_CAPTURE_WORKERS, thread_name_prefix='manual-capture')
+
+
+class CaptureBusyError(Exception):
+    pass
+
+
+def run_job(job, stream):
+    job.update({'status': 'running', 'started': time.time()})
+    try:
+        future = save_image_from_stream(stream, force=True)
+        filename = future.result(timeout=MANUAL_CAPTURE_SAVE_TIMEOUT) if future else None
+        if filename:
+            job.update({'status': 'done', 'filename': filename})
+            logger.debug(f'Image from "{job["stream"]}" successfully saved.')
+        else:
+            job.update({'status': 'skipped', 'error': 'The stream has disabled saving images or the set time '
+                                                      'for the stream has expired.'})
+    except TimeoutError:
+        job.update({'status': 'failed', 'error': 'The image wasn\'t saved in time.'})
+        logger.error(f'Manual capture of "{job["stream"]}" timed out.')
+    except (VideoCaptureException, DiskSpaceError, PipelineFullError, OSError, ValueError) as e:
+        job.update({'status': 'failed', 'error': str(e)})
+        logger.error(e)
+    except Exception as e:
+        # Anything re-raised from the encode or write stage (cv2.error, sqlite3.Error) must still end the job.
+        job.update({'status': 'failed', 'error': str(e)})
+        logger.exception(f'Manual capture of "{job["stream"]}" failed: {e}')
+    finally:
+        job['finished'] = time.time()
+
+
+def is_pending(job):
+    return job['status'] in ('queued', 'running')
+
+
+def request_capture(stream):
+    now = time.time()
+    with jobs_lock:
+        for job_id in [job_id for job_id, old_job in jobs.items()
+                       if old_job['created'] < now - MANUAL_CAPTURE_JOB_TTL and not is_pending(old_job)]:
+            del jobs[job_id]
+        job = latest_jobs.get(stream['name'])
+        if job is not None and (is_pending(job) or (job['finished'] or now) >= now - MANUAL_CAPTURE_COALESCE):
+            job['requests'] += 1
+            return job
+        if sum(1 for job in latest_jobs.values() if is_pending(job)) >= MANUAL_CAPTURE_MAX_PENDING:
+            raise CaptureBusyError('Too many captures are in progress, try again later.')
+        job = {
+            'id': uuid.uuid4().hex,
+            'stream': stream['name'],
+            'status': 'queued',
+            'filename': None,
+            'error': None,
+            'requests': 1,
+            'created': now,
+            'started': None,
+            'finished': None
+        }
+        jobs[job['id']] = job
+        latest_jobs[stream['name']] = job
+    executor.submit(run_job, job, stream)
+    return job
+
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+
+def drop_stream(stream_name):
+    with jobs_lock:
+        latest_jobs.pop(stream_name, None)
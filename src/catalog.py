@@ -0,0 +1,316 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from PIL import Image
+
+from config import CATALOG_DB, IMAGE_FOLDER
+
+logger = logging.getLogger('app')
+
+STALE_TEMP_AGE = 3600  # Seconds
+
+local = threading.local()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    stream TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    pack TEXT,
+    offset INTEGER,
+    crc INTEGER,
+    PRIMARY KEY (stream, filename)
+);
+CREATE INDEX IF NOT EXISTS images_stream_timestamp ON images (stream, timestamp);
+CREATE INDEX IF NOT EXISTS images_timestamp ON images (timestamp);
+'''
+# Columns added after the first release of the catalog.
+MIGRATIONS = {
+    'pack': 'ALTER TABLE images ADD COLUMN pack TEXT',
+    'offset': 'ALTER TABLE images ADD COLUMN offset INTEGER',
+    'crc': 'ALTER TABLE images ADD COLUMN crc INTEGER',
+}
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS images_pack ON images (pack);
+'''
+INSERT = ('INSERT OR REPLACE INTO images (stream, filename, timestamp, size, format, width, height, pack, offset, '
+          'crc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+def get_connection():
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(CATALOG_DB, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(images)')}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                connection.execute(statement)
+        connection.executescript(INDEXES)
+        local.connection = connection
+    return connection
+
+
+def add_image(stream_name, filename, timestamp, size, width=None, height=None, crc=None):
+    connection = get_connection()
+    with connection:
+        connection.execute(INSERT, (stream_name, filename, timestamp, size, os.path.splitext(filename)[1].lower(),
+                                    width, height, None, None, crc))
+
+
+def get_image(stream_name, filename):
+    return get_connection().execute('SELECT * FROM images WHERE stream = ? AND filename = ?',
+                                    (stream_name, filename)).fetchone()
+
+
+def get_unpacked_images(stream_name, before, limit):
+    return get_connection().execute('SELECT * FROM images WHERE stream = ? AND pack IS NULL AND timestamp < ? '
+                                    'ORDER BY timestamp LIMIT ?', (stream_name, before, limit)).fetchall()
+
+
+def set_packed(stream_name, entries):
+    connection = get_connection()
+    with connection:
+        connection.executemany('UPDATE images SET pack = ?, offset = ?, crc = ? WHERE stream = ? AND filename = ?',
+                               [(pack, offset, crc, stream_name, filename) for filename, pack, offset, crc in entries])
+
+
+def get_pack_images(pack):
+    return get_connection().execute('SELECT * FROM images WHERE pack = ? ORDER BY offset', (pack,)).fetchall()
+
+
+def is_pack_used(pack):
+    return get_connection().execute('SELECT 1 FROM images WHERE pack = ? LIMIT 1', (pack,)).fetchone() is not None
+
+
+def get_usage(stream_name=None):
+    connection = get_connection()
+    if stream_name is not None:
+        row = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images WHERE stream = ?',
+                                 (stream_name,)).fetchone()
+        return {'count': row[0], 'size': row[1]}
+    rows = connection.execute('SELECT stream, COUNT(*), COALESCE(SUM(size), 0) FROM images GROUP BY stream')
+    return {row[0]: {'count': row[1], 'size': row[2]} for row in rows}
+
+
+def list_images(stream_name, after=None, start=None, end=None, limit=None, through=None):
+    query = 'SELECT * FROM images WHERE stream = ?'
+    params = [stream_name]
+    if after is not None:
+        query += ' AND filename > ?'
+        params.append(after)
+    if through is not None:
+        query += ' AND filename <= ?'
+        params.append(through)
+    if start is not None:
+        query += ' AND timestamp >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND timestamp < ?'
+        params.append(end)
+    query += ' ORDER BY filename'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return get_connection().execute(query, params)
+
+
+def get_latest_image(stream_name):
+    return get_connection().execute('SELECT * FROM images WHERE stream = ? ORDER BY timestamp DESC LIMIT 1',
+                                    (stream_name,)).fetchone()
+
+
+def get_selection_stats(stream_name, start=None, end=None, limit=None):
+    # Changes whenever an image is added to or removed from the selection returned by list_images.
+    # The last column is the UTF-8 length of all file names, which fixes the layout of an archive.
+    query = ('SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(filename), MAX(filename), MAX(timestamp), '
+             'COALESCE(SUM(LENGTH(CAST(filename AS BLOB))), 0) '
+             'FROM (SELECT filename, size, timestamp FROM images WHERE stream = ?')
+    params = [stream_name]
+    if start is not None:
+        query += ' AND timestamp >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND timestamp < ?'
+        params.append(end)
+    query += ' ORDER BY filename'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    query += ')'
+    return tuple(get_connection().execute(query, params).fetchone())
+
+
+def count_images(stream_name, start=None, end=None):
+    query = 'SELECT COUNT(*) FROM images WHERE stream = ?'
+    params = [stream_name]
+    if start is not None:
+        query += ' AND timestamp >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND timestamp < ?'
+        params.append(end)
+    return get_connection().execute(query, params).fetchone()[0]
+
+
+def get_oldest_images(stream_name=None, limit=100, before=None):
+    query = 'SELECT * FROM images'
+    conditions = []
+    params = []
+    if stream_name is not None:
+        conditions.append('stream = ?')
+        params.append(stream_name)
+    if before is not None:
+        conditions.append('timestamp < ?')
+        params.append(before)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY timestamp LIMIT ?'
+    params.append(limit)
+    return get_connection().execute(query, params).fetchall()
+
+
+def delete_images(images):
+    connection = get_connection()
+    with connection:
+        connection.executemany('DELETE FROM images WHERE stream = ? AND filename = ?',
+                               [(image['stream'], image['filename']) for image in images])
+
+
+def delete_stream_images(stream_name):
+    connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM images WHERE stream = ?', (stream_name,))
+
+
+def get_image_size(path):
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except (OSError, IOError):
+        return None, None
+
+
+def scan_folder(folder):
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            yield from scan_folder(entry.path)
+        elif entry.is_file():
+            yield entry
+
+
+def read_pack_index(path):
+    pack = path[:-len('.idx')] + '.pack'
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                item = json.loads(line)
+                yield item['filename'], item['offset'], item['size'], item.get('timestamp'), item.get('crc'), pack
+
+
+def get_file_crc(path, offset=0, size=None):
+    crc = 0
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = file.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return crc
+
+
+def rebuild(stream_name):
+    folder = os.path.join(IMAGE_FOLDER, stream_name)
+    connection = get_connection()
+    known = {row['filename']: (row['size'], row['crc']) for row in
+             connection.execute('SELECT filename, size, crc FROM images WHERE stream = ?', (stream_name,))}
+    found = set()
+    added = 0
+    entries = scan_folder(folder) if os.path.isdir(folder) else []
+    with connection:
+        for entry in entries:
+            name = entry.name
+            if name.endswith('.idx'):
+                for filename, offset, size, timestamp, crc, pack in read_pack_index(entry.path):
+                    found.add(filename)
+                    known_size, known_crc = known.get(filename, (None, None))
+                    if known_size == size and known_crc is not None:
+                        continue
+                    # Rows from before the crc column get it filled in here.
+                    if crc is None:
+                        crc = get_file_crc(pack, offset, size)
+                    if known_size == size:
+                        connection.execute('UPDATE images SET crc = ? WHERE stream = ? AND filename = ?',
+                                           (crc, stream_name, filename))
+                    else:
+                        connection.execute(INSERT, (stream_name, filename, timestamp or entry.stat().st_mtime, size,
+                                                    os.path.splitext(filename)[1].lower(), None, None, pack, offset,
+                                                    crc))
+                    added += 1
+                continue
+            if name.startswith('.') and name.endswith('.tmp'):
+                # Left behind by a write interrupted before its rename; recent ones may still be in progress.
+                if entry.stat().st_mtime < time.time() - STALE_TEMP_AGE:
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+                continue
+            if name.endswith('.pack') or name.startswith('.'):
+                continue
+            found.add(name)
+            stat = entry.stat()
+            known_size, known_crc = known.get(name, (None, None))
+            if known_size == stat.st_size and known_crc is not None:
+                continue
+            crc = get_file_crc(entry.path)
+            if known_size == stat.st_size:
+                connection.execute('UPDATE images SET crc = ? WHERE stream = ? AND filename = ?',
+                                   (crc, stream_name, name))
+            else:
+                width, height = get_image_size(entry.path)
+                connection.execute(INSERT, (stream_name, name, stat.st_mtime, stat.st_size,
+                                            os.path.splitext(name)[1].lower(), width, height, None, None, crc))
+            added += 1
+        removed = [(stream_name, filename) for filename in known if filename not in found]
+        connection.executemany('DELETE FROM images WHERE stream = ? AND filename = ?', removed)
+    logger.info(f'Catalog for "{stream_name}" reconciled: {added} added or updated, {len(removed)} removed.')
+    return added, len(removed)
+
+
+def rebuild_all():
+    connection = get_connection()
+    streams = {row[0] for row in connection.execute('SELECT DISTINCT stream FROM images')}
+    if os.path.isdir(IMAGE_FOLDER):
+        streams.update(entry.name for entry in os.scandir(IMAGE_FOLDER) if entry.is_dir())
+    for stream_name in sorted(streams):
+        rebuild(stream_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile the screenshot catalog with the image folders.')
+    parser.add_argument('streams', nargs='*', help='Stream names to reconcile, all streams by default.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.streams:
+        for name in args.streams:
+            rebuild(name)
+    else:
+        rebuild_all()
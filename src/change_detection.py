@@ -0,0 +1,54 @@
+import threading
+
+import cv2
+import numpy as np
+
+from config import CHANGE_THRESHOLD, CHANGE_KEYFRAME_INTERVAL
+
+SIGNATURE_SIZE = (64, 36)
+
+states = {}
+states_lock = threading.Lock()
+
+
+def get_signature(frame):
+    small = cv2.resize(frame, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+
+def get_state(stream_name):
+    with states_lock:
+        return states.setdefault(stream_name, {'signature': None, 'since_save': 0, 'saved': 0, 'skipped': 0,
+                                               'difference': None})
+
+
+def should_save(stream, frame, force=False):
+    state = get_state(stream['name'])
+    if not stream.get('skip_similar'):
+        state['saved'] += 1
+        return True
+    signature = get_signature(frame)
+    threshold = stream.get('change_threshold')
+    threshold = CHANGE_THRESHOLD if threshold is None else threshold
+    keyframe_interval = stream.get('keyframe_interval') or CHANGE_KEYFRAME_INTERVAL
+    if state['signature'] is not None:
+        state['difference'] = float(np.mean(np.abs(signature - state['signature'])))
+    if (force or state['signature'] is None or state['since_save'] + 1 >= keyframe_interval
+            or state['difference'] > threshold):
+        state.update({'signature': signature, 'since_save': 0})
+        state['saved'] += 1
+        return True
+    state['since_save'] += 1
+    state['skipped'] += 1
+    return False
+
+
+def reset_state(stream_name):
+    with states_lock:
+        states.pop(stream_name, None)
+
+
+def get_stats():
+    with states_lock:
+        return {name: {'saved': state['saved'], 'skipped': state['skipped'], 'difference': state['difference']}
+                for name, state in states.items()}
@@ -1,6 +1,108 @@
+# Streams listed here are added to the stream registry on startup if missing.
 RTSP_STREAMS = []
+# SQLite database holding the stream registry.
+STATE_DB = 'state.db'
+# The web process checks the registry for changes made by other processes,
+# e.g. "python bulk.py import", this often and updates the capture jobs.
+STATE_RELOAD_INTERVAL = 30  # Seconds
 IMAGE_FOLDER = 'images'
-TEMP_FOLDER = 'temp'
+# Images are stored as <stream>/YYYY/MM/DD/<file>. Move existing flat folders with
+# "python storage.py migrate". Files left in the flat layout are still served.
+STORAGE_SHARD_BY_DATE = True
+# Append the images of closed days to one <stream>/YYYY/MM/DD.pack segment per day
+# with a DD.idx offset index, instead of keeping thousands of small files.
+STORAGE_PACK_CLOSED_DAYS = False
+STORAGE_PACK_HOUR = 1  # Local hour of the daily packing run
+# SQLite catalog of saved screenshots. Rebuild it with "python catalog.py".
+CATALOG_DB = 'catalog.db'
+# With WORKER_MODE enabled the web process does not capture. Run one or more
+# "python worker.py" processes instead; streams are sharded between live workers
+# and rebalanced when a worker stops sending heartbeats.
+WORKER_MODE = False
+WORKER_HEARTBEAT_INTERVAL = 10  # Seconds
+WORKER_TIMEOUT = 30  # Seconds
+# Capture scheduler. Each stream fires at a fixed, name-derived offset within its
+# interval so streams sharing an interval do not all start in the same second.
+SCHEDULER_MAX_WORKERS = 20
+SCHEDULER_MAX_INSTANCES = 1
+SCHEDULER_COALESCE = True
+SCHEDULER_MISFIRE_GRACE_TIME = 30  # Seconds
+# Retention. Per-stream limits (overridable on the stream edit page) and global
+# limits; None disables a limit. The oldest images are deleted in batches in the
+# background so saving can continue. RETENTION_KEEP_FREE_GB deletes the oldest
+# images of all streams while free disk space is below it; keep it above
+# FREE_DISK_SPACE_GB so cleanup starts before the low disk space alert.
+RETENTION_MAX_AGE_DAYS = None
+RETENTION_MAX_COUNT = None
+RETENTION_MAX_MB = None
+RETENTION_TOTAL_MAX_GB = None
+RETENTION_KEEP_FREE_GB = None
+RETENTION_BATCH_SIZE = 500
+RETENTION_INTERVAL = 10  # Minutes
+# Defaults for streams with "Skip similar frames" enabled: a frame is stored when
+# the mean grayscale difference (0-255) of its downscaled copy to the last stored
+# frame exceeds the threshold, and at least every N intervals regardless.
+CHANGE_THRESHOLD = 4
+CHANGE_KEYFRAME_INTERVAL = 60
+# Captured frames are resized, encoded and written by worker pools fed through
+# bounded queues. When the encode queue is full new frames are dropped instead
+# of stalling capture. ENCODE_USE_PROCESSES runs encoding in separate processes.
+ENCODE_WORKERS = 4
+ENCODE_USE_PROCESSES = False
+ENCODE_QUEUE_SIZE = 64
+WRITE_WORKERS = 2
+WRITE_QUEUE_SIZE = 64
+# Thumbnails are written at capture time or generated on first request and kept
+# in this folder. The oldest ones are evicted once the cache exceeds its size limit.
+THUMBNAIL_FOLDER = 'thumbnails'
+THUMBNAIL_SIZE = (80, 80)
+THUMBNAIL_QUALITY = 70
+THUMBNAIL_CACHE_MAX_MB = 1024
+# Captures requested from the web interface run in the background. A request for
+# a stream whose capture is queued, running or finished less than
+# MANUAL_CAPTURE_COALESCE seconds ago shares that capture instead of opening
+# the camera again. At most MANUAL_CAPTURE_MAX_PENDING captures wait at once.
+MANUAL_CAPTURE_WORKERS = 4
+MANUAL_CAPTURE_MAX_PENDING = 32
+MANUAL_CAPTURE_COALESCE = 5  # Seconds
+MANUAL_CAPTURE_JOB_TTL = 3600  # Seconds
+MANUAL_CAPTURE_SAVE_TIMEOUT = 60  # Seconds to wait for the encode and write stages
+# The most recent frames of every stream are kept in memory as JPEG for
+# /<stream>/latest.jpg and the MJPEG preview, so viewers never open the camera.
+# Frames captured by worker processes don't reach the web process; latest.jpg
+# then falls back to the newest saved image.
+# JPEG captures up to PREVIEW_WIDTH are buffered as saved. Other captures need
+# an extra resize and JPEG encode, done only for streams that had a latest.jpg
+# or MJPEG request in the last PREVIEW_DEMAND_TIMEOUT seconds.
+PREVIEW_BUFFER_SIZE = 5  # Frames per stream, 0 disables the buffer
+PREVIEW_DEMAND_TIMEOUT = 300  # Seconds
+PREVIEW_WIDTH = 1280
+PREVIEW_QUALITY = 80
+PREVIEW_FPS = 2  # Upper limit of the MJPEG preview
+PREVIEW_MAX_VIEWERS = 20  # Each MJPEG viewer holds a web server thread
+# Time-lapse export. Daily segments are cached in TIMELAPSE_FOLDER and reused
+# until new images are added to that day. Joining several days re-encodes the
+# segments once, the result is cached for the same days and reused for
+# TIMELAPSE_EXPORT_TTL hours after its last request. A single day is the
+# segment itself.
+TIMELAPSE_FOLDER = 'timelapse'
+TIMELAPSE_FPS = 25
+TIMELAPSE_WIDTH = 1280
+TIMELAPSE_FOURCC = 'mp4v'
+TIMELAPSE_WORKERS = 1
+TIMELAPSE_EXPORT_TTL = 24  # Hours
+# Saved images never change, so browsers may keep them and their thumbnails this long.
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600  # Seconds
+# Contact sheets tile the thumbnails of a day or an hour into one image. They are
+# built on first request and cached until new images arrive; the most recent
+# sheets stay in memory so new images are added without rebuilding the sheet.
+CONTACT_SHEET_FOLDER = 'contact_sheets'
+CONTACT_SHEET_COLUMNS = 20
+CONTACT_SHEET_MAX_TILES = 2000
+CONTACT_SHEET_QUALITY = 85
+CONTACT_SHEET_MEMORY_CACHE = 8  # Sheets
+# Number of files shown per page of the file list.
+FILES_PAGE_SIZE = 100
 SECRET_KEY = 'your_secret_key'
 TIMEZONE = 'Europe/Moscow'
 
@@ -9,10 +111,52 @@ USERS = {
         'password': 'admin'
     }
 }
-# Required amount of free disk space in GB. It is used to define the minimum
-# disk space that should be available on the disk.
+# The periodic check alerts and starts a retention cleanup when free disk space
+# drops below FREE_DISK_SPACE_GB. Saving is refused only when writing the
+# encoded image would leave less than DISK_RESERVE_MB free.
 FREE_DISK_SPACE_GB = 2
-DELETE_ARCHIVES_DELAY = 60  # Minutes
+DISK_RESERVE_MB = 200
+# Images are written to a temporary name and renamed, so a crash or a full disk
+# never leaves a truncated image under its final name. DURABILITY sets when the
+# data is forced to disk:
+# 'file' - every image and its folder are synced before the image is cataloged
+# 'batch' - the images of a folder are synced every DURABILITY_BATCH_FILES images
+#           or DURABILITY_BATCH_SECONDS; a power loss may lose the latest batch
+# 'none' - left to the operating system
+DURABILITY = 'batch'
+DURABILITY_BATCH_FILES = 50
+DURABILITY_BATCH_SECONDS = 5
+# Stream probe results shown on the main page are refreshed by the periodic
+# stream check and treated as unknown once older than this.
+STREAM_INFO_TTL = 15 * 60  # Seconds
+# The periodic stream check probes this many streams in parallel, each bounded by the timeouts below.
+STREAM_CHECK_WORKERS = 16
+STREAM_CHECK_OPEN_TIMEOUT = 10  # Seconds
+STREAM_CHECK_READ_TIMEOUT = 10  # Seconds
+# Streams with "Keep stream open" enabled hold their RTSP connection between
+# captures. A session unused for this long is closed and reopened on demand.
+CAPTURE_SESSION_IDLE_TIMEOUT = 600  # Seconds
+# Delay before reconnecting a dead session, doubled after each failure up to the maximum.
+CAPTURE_SESSION_RETRY_DELAY = 5  # Seconds
+CAPTURE_SESSION_MAX_RETRY_DELAY = 300  # Seconds
+# Capture timeouts for streams that don't set their own, None keeps the FFmpeg defaults.
+CAPTURE_OPEN_TIMEOUT = None  # Seconds
+CAPTURE_READ_TIMEOUT = None  # Seconds
+# FFmpeg options (transport, probe size, analyze duration) are process-wide, so
+# once streams use different options their opens take turns: a slow open holds
+# back every open with other options until it finishes. From then on opens
+# without an open timeout use this one instead of the FFmpeg default, which
+# is logged once. Stream checks run grouped by options to limit the turns.
+CAPTURE_MIXED_OPTIONS_OPEN_TIMEOUT = 15  # Seconds
 USE_TELEGRAM_BOT = True
 TELEGRAM_BOT_TOKEN = '0000000000:00000000000000000000000000000000000'
 TELEGRAM_BOT_CHAT_ID = 111111111
+# Log records are written and sent from a background thread. Warnings that
+# differ only in quoted names, like a stream name, are combined into one alert
+# per ALERT_WINDOW, and at most ALERT_MAX_PER_HOUR alerts are sent.
+ALERT_WINDOW = 60  # Seconds
+ALERT_MAX_PER_HOUR = 30
+LOG_QUEUE_SIZE = 10000
+# Write alerts to ALERT_STUB_FILE instead of sending them to Telegram, for testing.
+ALERT_STUB = False
+ALERT_STUB_FILE = 'alerts.log'
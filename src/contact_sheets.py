@@ -0,0 +1,124 @@
+import collections
+import datetime
+import glob
+import os
+import shutil
+import threading
+
+import cv2
+import numpy as np
+import pytz
+
+import catalog
+import storage
+import thumbnails
+from config import (TIMEZONE, THUMBNAIL_SIZE, CONTACT_SHEET_FOLDER, CONTACT_SHEET_COLUMNS, CONTACT_SHEET_MAX_TILES,
+                    CONTACT_SHEET_QUALITY, CONTACT_SHEET_MEMORY_CACHE)
+
+# (stream, day, hour) -> {'files': [...], 'array': ndarray} of recently built sheets.
+sheets = collections.OrderedDict()
+build_lock = threading.Lock()
+
+
+def get_bounds(day, hour=None):
+    tz = pytz.timezone(TIMEZONE)
+    if hour is None:
+        start = tz.localize(datetime.datetime.combine(day, datetime.time()))
+        end = tz.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()))
+    else:
+        start = tz.localize(datetime.datetime.combine(day, datetime.time(hour)))
+        end = start + datetime.timedelta(hours=1)
+    return start.timestamp(), end.timestamp()
+
+
+def get_mapping(stream_name, day, hour=None):
+    start, end = get_bounds(day, hour)
+    files = [row['filename'] for row in catalog.list_images(stream_name, start=start, end=end,
+                                                            limit=CONTACT_SHEET_MAX_TILES)]
+    return {
+        'columns': CONTACT_SHEET_COLUMNS,
+        'tile_width': THUMBNAIL_SIZE[0],
+        'tile_height': THUMBNAIL_SIZE[1],
+        'files': files,
+        'truncated': len(files) >= CONTACT_SHEET_MAX_TILES
+    }
+
+
+def load_tile(stream_name, filename):
+    # Cached thumbnails are tiny, the original is decoded at 1/8 scale only when there is none.
+    tile = None
+    thumbnail_path = thumbnails.get_thumbnail_path(stream_name, filename)
+    if os.path.exists(thumbnail_path):
+        tile = cv2.imread(thumbnail_path)
+    if tile is None:
+        try:
+            data = storage.read_image(stream_name, filename)
+        except OSError:
+            return None
+        tile = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+        if tile is None:
+            return None
+    height, width = tile.shape[:2]
+    scale = min(THUMBNAIL_SIZE[0] / width, THUMBNAIL_SIZE[1] / height, 1)
+    if scale < 1:
+        tile = cv2.resize(tile, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                          interpolation=cv2.INTER_AREA)
+    return tile
+
+
+def build_sheet(stream_name, files, previous=None):
+    tile_width, tile_height = THUMBNAIL_SIZE
+    rows = -(-len(files) // CONTACT_SHEET_COLUMNS)
+    sheet = np.zeros((rows * tile_height, CONTACT_SHEET_COLUMNS * tile_width, 3), np.uint8)
+    first = 0
+    # Images only get appended to a day, so the tiles of the previous build are copied in one slice.
+    if previous is not None and files[:len(previous['files'])] == previous['files']:
+        sheet[:previous['array'].shape[0]] = previous['array']
+        first = len(previous['files'])
+    for index in range(first, len(files)):
+        tile = load_tile(stream_name, files[index])
+        if tile is None:
+            continue
+        row, column = divmod(index, CONTACT_SHEET_COLUMNS)
+        height, width = tile.shape[:2]
+        y = row * tile_height + (tile_height - height) // 2
+        x = column * tile_width + (tile_width - width) // 2
+        sheet[y:y + height, x:x + width] = tile
+    return sheet
+
+
+def get_sheet(stream_name, day, hour=None):
+    mapping = get_mapping(stream_name, day, hour)
+    files = mapping['files']
+    if not files:
+        return None, mapping
+    prefix = f'{day.isoformat()}_{"all" if hour is None else f"{hour:02d}"}'
+    folder = os.path.join(CONTACT_SHEET_FOLDER, stream_name)
+    # Keyed by the image count like the time-lapse segments, a new image makes a new sheet.
+    path = os.path.join(folder, f'{prefix}_{len(files)}.jpg')
+    if os.path.exists(path):
+        return path, mapping
+    with build_lock:
+        if os.path.exists(path):
+            return path, mapping
+        key = (stream_name, day, hour)
+        sheet = build_sheet(stream_name, files, sheets.get(key))
+        ret, buffer = cv2.imencode('.jpg', sheet, [int(cv2.IMWRITE_JPEG_QUALITY), CONTACT_SHEET_QUALITY])
+        if not ret:
+            raise OSError(f'Failed to encode the contact sheet of "{stream_name}" for {prefix}.')
+        os.makedirs(folder, exist_ok=True)
+        for outdated in glob.glob(os.path.join(folder, glob.escape(prefix) + '_*.jpg')):
+            os.unlink(outdated)
+        storage.write_file(path, buffer.tobytes())
+        sheets[key] = {'files': files, 'array': sheet}
+        sheets.move_to_end(key)
+        while len(sheets) > CONTACT_SHEET_MEMORY_CACHE:
+            sheets.popitem(last=False)
+    return path, mapping
+
+
+def delete_sheets(stream_name):
+    with build_lock:
+        for key in [key for key in sheets if key[0] == stream_name]:
+            del sheets[key]
+    shutil.rmtree(os.path.join(CONTACT_SHEET_FOLDER, stream_name), ignore_errors=True)
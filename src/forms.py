@@ -4,8 +4,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, IntegerField, BooleanField, SelectField, PasswordField, SubmitField, TimeField
 from wtforms.validators import DataRequired, NumberRange, ValidationError, Regexp, Optional, StopValidation
 
-from config import RTSP_STREAMS
 from functions import get_stream
+from registry import streams
 
 
 def stream_name_check(_, field):
@@ -14,9 +14,25 @@ def stream_name_check(_, field):
 
 
 def stream_url_check(_, field):
-    for stream in RTSP_STREAMS:
-        if field.data == stream['url']:
-            raise ValidationError(f'This url "{field.data}" already exists.')
+    if streams.get_by_url(field.data):
+        raise ValidationError(f'This url "{field.data}" already exists.')
+
+
+def other_stream_name_check(form, field):
+    owner = get_stream(field.data)
+    if owner is not None and owner is not form.stream:
+        raise ValidationError(f'This name "{field.data}" already exists.')
+
+
+def other_stream_url_check(form, field):
+    owner = streams.get_by_url(field.data)
+    if owner is not None and owner is not form.stream:
+        raise ValidationError(f'This url "{field.data}" already exists.')
+
+
+def renamed_folder_exist(form, field):
+    if form.stream is not None and field.data != form.stream['name']:
+        stream_folder_exist(form, field)
 
 
 def stream_folder_exist(_, field):
@@ -66,13 +82,31 @@ class SaveTimeInterval(StreamForm):
 
 
 class EditStreamForm(SaveTimeInterval):
+    name = StringField('Name', validators=[DataRequired(), other_stream_name_check, renamed_folder_exist])
+    url = StringField('URL', validators=[DataRequired(), RTSPURLValidator(), other_stream_url_check])
     save_images = BooleanField('Save images', default=True)
+    keep_open = BooleanField('Keep stream open between captures', default=False)
+    substream_url = StringField('Sub-stream URL for checks', validators=[Optional(), RTSPURLValidator()])
+    capture_transport = SelectField('RTSP transport', choices=[('tcp', 'TCP'), ('udp', 'UDP')], default='tcp')
+    capture_open_timeout = IntegerField('Open timeout (s)', validators=[Optional(), NumberRange(min=1, max=300)])
+    capture_read_timeout = IntegerField('Read timeout (s)', validators=[Optional(), NumberRange(min=1, max=300)])
+    capture_probesize = IntegerField('Probe size (bytes)', validators=[Optional(), NumberRange(min=32)])
+    capture_analyzeduration = IntegerField('Analyze duration (ms)', validators=[Optional(), NumberRange(min=0)])
     resize = BooleanField('Resize', default=False)
     im_res_width = IntegerField("Image width", validators=[RequiredTogether('resize'), Optional()])
     im_res_height = IntegerField("Image height", validators=[RequiredTogether('resize'), Optional()])
+    resize_interpolation = SelectField("Resize interpolation",
+                                       choices=[('linear', 'Linear'), ('area', 'Area (sharper when downscaling)'),
+                                                ('nearest', 'Nearest (fastest)'), ('cubic', 'Cubic')],
+                                       default='linear')
     extension = SelectField("Extension",
-                            choices=[('.jpg', 'JPG'), ('.jp2', 'JPEG 2000'), ('.webp', 'WEBP'), ('.png', 'PNG')]
-                            )
+                            choices=[('.jpg', 'JPG'), ('.jp2', 'JPEG 2000'), ('.webp', 'WEBP'), ('.png', 'PNG')],
+                            default='.jpg')
+    skip_similar = BooleanField('Skip similar frames', default=False)
+    change_threshold = IntegerField('Change threshold (0-255)', validators=[Optional(), NumberRange(min=0, max=255)],
+                                    default=4)
+    keyframe_interval = IntegerField('Save at least every N intervals', validators=[Optional(), NumberRange(min=1)],
+                                     default=60)
     use_flags = BooleanField('Use quality flags', default=False)
     jpg_quality = IntegerField('JPG Quality (0-100)', validators=[NumberRange(min=0, max=100)], default=95)
     jpg_optimize = IntegerField('JPG Optimize (0-1)', validators=[NumberRange(min=0, max=1)], default=0)
@@ -80,3 +114,11 @@ class EditStreamForm(SaveTimeInterval):
                                    validators=[NumberRange(min=0, max=1000)], default=1000)
     webp_quality = IntegerField('Webp Quality (1-100)', validators=[NumberRange(min=1, max=100)], default=100)
     png_compression = IntegerField('PNG Compression (0-9)', validators=[NumberRange(min=0, max=9)], default=1)
+    retention_max_age_days = IntegerField('Keep images for (days)', validators=[Optional(), NumberRange(min=1)])
+    retention_max_count = IntegerField('Keep at most (images)', validators=[Optional(), NumberRange(min=1)])
+    retention_max_mb = IntegerField('Keep at most (MB)', validators=[Optional(), NumberRange(min=1)])
+
+    def __init__(self, *args, stream=None, **kwargs):
+        # The stream being edited, it may keep its own name and url.
+        self.stream = stream
+        super().__init__(*args, **kwargs)
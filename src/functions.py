@@ -1,23 +1,59 @@
 import datetime
-import json
 import logging
 import os
 import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import pytz
-
-from config import RTSP_STREAMS, IMAGE_FOLDER, FREE_DISK_SPACE_GB, TIMEZONE, TEMP_FOLDER
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import catalog
+import change_detection
+import metrics
+import retention
+import storage
+from storage import DiskSpaceError
+from capture import grab_frame, open_stream, get_capture_options, VideoCaptureException
+from pipeline import submit, SaveTask, PipelineFullError, get_pipeline_stats, INTERPOLATIONS
+from registry import streams, dump_stream
+from config import (IMAGE_FOLDER, FREE_DISK_SPACE_GB, TIMEZONE, STREAM_INFO_TTL,
+                    STREAM_CHECK_WORKERS, STREAM_CHECK_OPEN_TIMEOUT, STREAM_CHECK_READ_TIMEOUT,
+                    SCHEDULER_MAX_WORKERS, SCHEDULER_MAX_INSTANCES, SCHEDULER_COALESCE,
+                    SCHEDULER_MISFIRE_GRACE_TIME, WORKER_MODE, DISK_RESERVE_MB)
 
 logger = logging.getLogger('app')
 
+stream_info_cache = {}
+stream_info_lock = threading.Lock()
+job_timing = {}
+
+# Interval jobs are anchored to a fixed date so each stream keeps the same phase across restarts.
+PHASE_ANCHOR = datetime.datetime(2000, 1, 1, tzinfo=pytz.utc)
 
-class DiskSpaceError(Exception):
-    pass
 
+def create_scheduler():
+    scheduler = BackgroundScheduler(
+        executors={'default': SchedulerThreadPoolExecutor(SCHEDULER_MAX_WORKERS)},
+        job_defaults={
+            'max_instances': SCHEDULER_MAX_INSTANCES,
+            'coalesce': SCHEDULER_COALESCE,
+            'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_TIME
+        },
+        timezone=TIMEZONE
+    )
+    scheduler.add_listener(record_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    return scheduler
 
-class VideoCaptureException(Exception):
-    pass
+
+def get_phase_offset(stream):
+    return zlib.crc32(stream['name'].encode()) % (stream['interval'] * 60)
 
 
 def add_scheduler_job(scheduler, stream):
@@ -26,111 +62,182 @@ def add_scheduler_job(scheduler, stream):
         'interval',
         [stream],
         minutes=stream['interval'],
+        start_date=PHASE_ANCHOR + datetime.timedelta(seconds=get_phase_offset(stream)),
         id=stream['name']
     )
 
 
+def reschedule_stream(scheduler, stream_name, stream=None):
+    try:
+        scheduler.remove_job(stream_name)
+    except JobLookupError:
+        logger.debug(f'No capture job for "{stream_name}" to remove.')
+    # In worker mode captures run in worker.py processes, the web process only keeps the registry.
+    if stream is not None and not WORKER_MODE:
+        add_scheduler_job(scheduler, stream)
+
+
+def sync_scheduler(scheduler, wanted_streams, scheduled):
+    wanted = {stream['name']: stream for stream in wanted_streams if stream.get('save_images', True)}
+    for name in list(scheduled):
+        if name not in wanted:
+            reschedule_stream(scheduler, name)
+            del scheduled[name]
+    for name, stream in wanted.items():
+        state = dump_stream(stream)
+        if scheduled.get(name) != state:
+            try:
+                scheduler.remove_job(name)
+            except JobLookupError:
+                pass
+            add_scheduler_job(scheduler, stream)
+            scheduled[name] = state
+
+
+def record_job_event(event):
+    timing = job_timing.setdefault(event.job_id, {'planned': None, 'started': None, 'lag': None, 'missed': 0})
+    if event.code == EVENT_JOB_SUBMITTED:
+        timing['planned'] = event.scheduled_run_times[-1]
+        timing['pending'] = get_stream(event.job_id) is not None
+    else:
+        timing['missed'] += 1
+
+
+def record_job_start(job_id):
+    timing = job_timing.get(job_id)
+    if timing and timing['planned']:
+        timing['pending'] = False
+        timing['started'] = datetime.datetime.now(pytz.utc)
+        timing['lag'] = (timing['started'] - timing['planned']).total_seconds()
+
+
+def get_scheduler_context(scheduler):
+    context = []
+    for stream in streams:
+        job = scheduler.get_job(stream['name'])
+        timing = job_timing.get(stream['name'], {})
+        context.append({
+            'name': stream['name'],
+            'interval': stream['interval'],
+            'offset': get_phase_offset(stream),
+            'next_run': job.next_run_time if job else None,
+            'planned': timing.get('planned'),
+            'started': timing.get('started'),
+            'lag': timing.get('lag'),
+            'missed': timing.get('missed', 0)
+        })
+    context.sort(key=lambda item: (item['next_run'] is None, item['next_run'] or PHASE_ANCHOR))
+    return context
+
+
 def check_stream_and_space_job():
-    for stream in RTSP_STREAMS:
-        if not get_stream_info(stream['url'])['work']:
-            logger.error('The stream "{}" is not available.'.format(stream['name']))
+    with metrics.stream_check_seconds.time():
+        check_streams()
     try:
         check_disk_space()
     except DiskSpaceError:
+        retention.request_cleanup()
         logger.error('There is little space left on the device. Images cannot be saved.')
 
 
+def check_streams():
+    started = time.monotonic()
+    # Grouped by capture options, so the process-wide FFmpeg options change once per group instead of
+    # making consecutive checks take turns.
+    checked_streams = sorted(streams, key=get_capture_options)
+    with ThreadPoolExecutor(max_workers=STREAM_CHECK_WORKERS, thread_name_prefix='stream-check') as executor:
+        results = list(executor.map(refresh_stream_info, checked_streams))
+    if results:
+        slowest_stream, slowest = max(zip(checked_streams, results), key=lambda item: item[1]['latency'])
+        logger.info('Checked {} streams in {:.1f} s, {} not available, slowest "{}" {:.2f} s.'.format(
+            len(results), time.monotonic() - started, sum(not info['work'] for info in results),
+            slowest_stream['name'], slowest['latency']))
+    pipeline_stats = get_pipeline_stats()
+    logger.info('Save pipeline: encode queue {encode_queue}/{encode_queue_size}, write queue '
+                '{write_queue}/{write_queue_size}, {written} written, {dropped} dropped, '
+                '{failed} failed.'.format(**pipeline_stats))
+
+
 def save_image_job(stream):
+    record_job_start(stream['name'])
     try:
         save_image_from_stream(stream)
-    except (VideoCaptureException, DiskSpaceError) as e:
+    except (VideoCaptureException, DiskSpaceError, PipelineFullError) as e:
         logger.error(e)
 
 
-def load_scheduler(scheduler):
-    for stream in RTSP_STREAMS:
-        if 'save_images' not in stream or stream['save_images']:
-            add_scheduler_job(scheduler, stream)
-
-
 def get_folder_by_stream_name(stream_name):
     return os.path.join(IMAGE_FOLDER, get_stream(stream_name)['name'])
 
 
 def get_index_context():
     context = []
-    for cam in RTSP_STREAMS:
+    usage = retention.get_usage()
+    change_stats = change_detection.get_stats()
+    for cam in streams:
         context.append(cam.copy())
-        try:
-            context[-1].update({"screenshots": len(os.listdir(os.path.join(IMAGE_FOLDER, cam['name'])))})
-        except FileNotFoundError:
-            context[-1].update({"screenshots": 0})
-        context[-1].update({'info': get_stream_info(cam['url'])})
+        stream_usage = usage.get(cam['name'], {'count': 0, 'size': 0})
+        context[-1].update({"screenshots": stream_usage['count'], "screenshots_size": stream_usage['size']})
+        context[-1].update({'info': get_cached_stream_info(cam)})
+        context[-1].update({'changes': change_stats.get(cam['name'])})
     return context
 
 
-def get_stream(stream_name):
-    for stream in RTSP_STREAMS:
-        if stream['name'] == stream_name:
-            return stream
-    return None
-
-
-def load_with_datetime(pairs):
-    d = {}
-    converters = [
-        datetime.datetime.fromisoformat,
-        datetime.date.fromisoformat,
-        datetime.time.fromisoformat
-    ]
-    for k, v in pairs:
-        if isinstance(v, str):
-            for converter in converters:
-                try:
-                    d[k] = converter(v)
-                    break
-                except ValueError:
-                    pass
-            else:
-                d[k] = v
-        else:
-            d[k] = v
-    return d
+def refresh_stream_info(stream):
+    started = time.monotonic()
+    info = get_stream_info(stream)
+    info.update({'url': stream['url'], 'substream': bool(stream.get('substream_url')), 'checked': time.time(),
+                 'latency': time.monotonic() - started})
+    metrics.stream_probe_seconds.observe(info['latency'])
+    with stream_info_lock:
+        previous = stream_info_cache.get(stream['name'])
+        stream_info_cache[stream['name']] = info
+    # Alert only when the state changes, not on every check of a stream that stays down.
+    if not info['work'] and (previous is None or previous['work']):
+        logger.error('The stream "{}" is not available.'.format(stream['name']))
+    elif info['work'] and previous is not None and not previous['work']:
+        logger.warning('The stream "{}" is available again.'.format(stream['name']))
+    return info
+
+
+def get_cached_stream_info(stream):
+    info = stream_info_cache.get(stream['name'])
+    if info is None or info['url'] != stream['url'] or time.time() - info['checked'] > STREAM_INFO_TTL:
+        return None
+    return info
 
 
-def save_state():
-    for stream in RTSP_STREAMS:
-        stream_folder = os.path.join(IMAGE_FOLDER, stream['name'])
-        if not os.path.exists(stream_folder):
-            os.makedirs(stream_folder)
-    with open('state.json', 'w') as file:
-        json.dump(RTSP_STREAMS, file, indent=4, sort_keys=True,
-                  default=lambda obj: obj.isoformat() if hasattr(obj, 'isoformat') else obj)
+def drop_stream_info(stream_name):
+    with stream_info_lock:
+        stream_info_cache.pop(stream_name, None)
 
 
-def load_state():
+def parse_datetime_arg(value):
+    if not value:
+        return None
     try:
-        with open('state.json', 'r') as file:
-            RTSP_STREAMS.extend(json.load(file, object_pairs_hook=load_with_datetime))
-    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-        logger.critical('Failed to read the thread settings file. The list is cleared. Error: {}'.format(e))
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = pytz.timezone(TIMEZONE).localize(dt)
+    return dt.timestamp()
 
 
-def delete_archive(stream_name):
-    file_path = os.path.join(TEMP_FOLDER, f'{stream_name}.zip')
-    if os.path.exists(file_path):
-        os.unlink(file_path)
-        return True
-    return False
+def get_files_page(stream_name, after=None, start=None, end=None, limit=None):
+    rows = catalog.list_images(stream_name, after=after, start=parse_datetime_arg(start),
+                               end=parse_datetime_arg(end), limit=limit + 1).fetchall()
+    next_after = rows[limit - 1]['filename'] if len(rows) > limit else None
+    return rows[:limit], next_after
 
 
-def delete_old_archives():
-    for file in os.listdir(TEMP_FOLDER):
-        os.unlink(os.path.join(TEMP_FOLDER, file))
+def get_stream(stream_name):
+    return streams.get(stream_name)
 
 
-def get_stream_info(stream_url):
-    cap = cv2.VideoCapture(stream_url)
+def get_stream_info(stream):
+    # Probing the low resolution sub-stream, when there is one, is cheaper for the camera and for us.
+    cap = open_stream(stream, stream.get('substream_url'), STREAM_CHECK_OPEN_TIMEOUT, STREAM_CHECK_READ_TIMEOUT)
 
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -185,7 +292,7 @@ def check_disk_space(path=IMAGE_FOLDER, required_space=FREE_DISK_SPACE_GB):
         raise DiskSpaceError("Not enough disk space available. {} GB required.".format(required_space))
 
 
-def save_image_from_stream(stream):
+def save_image_from_stream(stream, force=False):
     current_datetime = datetime.datetime.now().astimezone(pytz.timezone(TIMEZONE))
     if not stream.get('save_images', True):
         return None
@@ -197,29 +304,37 @@ def save_image_from_stream(stream):
         elif not (start_time and end_time):
             raise ValueError('Invalid values for save_time_start or save_time_end.'
                              ' Stream: {}'.format(stream['name']))
-    check_disk_space()
-
-    save_folder = os.path.join(IMAGE_FOLDER, stream['name'])
-    os.makedirs(save_folder, exist_ok=True)
+    # Cheap early exit before the camera is opened, the exact check happens when the encoded image is written.
+    try:
+        check_disk_space(required_space=DISK_RESERVE_MB / 1024)
+    except DiskSpaceError:
+        metrics.capture_failures_total.inc('disk')
+        retention.request_cleanup()
+        raise
 
-    cap = cv2.VideoCapture(stream['url'])
-    ret, frame = cap.read()
-    if not ret:
-        raise VideoCaptureException('Failed to capture frame from the video stream. The stream'
-                                    ' may not be available. Stream: {}'.format(stream['name']))
+    frame = grab_frame(stream)
+    if not change_detection.should_save(stream, frame, force):
+        return None
 
+    size = None
     if stream.get('resize'):
         if isinstance(stream.get('im_res_width'), int) and isinstance(stream.get('im_res_height'), int):
-            frame = cv2.resize(frame, (int(stream.get('im_res_width')), int(stream.get('im_res_height'))))
+            size = (int(stream.get('im_res_width')), int(stream.get('im_res_height')))
         else:
             logger.error('The resize function was specified but no parameters were specified.'
                          ' Stream: "{}"'.format(stream['name']))
-    cap.release()
 
     extension = stream.get('extension', '.jpg')
     flags = get_flags(stream, extension)
 
     filename = f'{stream["name"]}_{current_datetime.strftime("%Y-%m-%d_%H-%M-%S")}{extension}'
-    save_path = os.path.abspath(os.path.join(save_folder, filename))
+    save_folder = storage.get_image_folder(stream['name'], filename)
+    return submit(SaveTask(stream['name'], save_folder, filename, current_datetime.timestamp(),
+                           frame, extension, flags, size, INTERPOLATIONS.get(stream.get('resize_interpolation'),
+                                                                              cv2.INTER_LINEAR)))
+
 
-    return cv2.imwrite(save_path, frame, flags)
+metrics.Gauge('rtsp_scheduler_pending_jobs', 'Capture jobs submitted to the scheduler executor but not started.',
+              function=lambda: sum(1 for timing in list(job_timing.values()) if timing.get('pending')))
+metrics.Gauge('rtsp_free_disk_bytes', 'Free space on the image disk.',
+              function=lambda: shutil.disk_usage(IMAGE_FOLDER).free)
@@ -0,0 +1,137 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{format_labels(self.label_names, labels)} {value}' for labels, value in values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        self.function = function
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception:
+                values = {}
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [f'{self.name}{format_labels(self.label_names, labels)} {value}' for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts[0]), counts[1]) for labels, counts in self.values.items()}
+        lines = []
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, labels, ("le", bound))} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+capture_stage_seconds = Histogram('rtsp_capture_stage_seconds',
+                                  'Duration of capture pipeline stages.', ['stage'])
+captures_total = Counter('rtsp_captures_total', 'Images saved.')
+capture_failures_total = Counter('rtsp_capture_failures_total', 'Failed captures by cause.', ['cause'])
+bytes_written_total = Counter('rtsp_bytes_written_total', 'Bytes of images written to disk.')
+stream_probe_seconds = Histogram('rtsp_stream_probe_seconds', 'Duration of stream probes.')
+stream_check_seconds = Histogram('rtsp_stream_check_seconds', 'Duration of the periodic stream check.',
+                                 buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+thumbnail_seconds = Histogram('rtsp_thumbnail_seconds', 'Duration of thumbnail requests.', ['cache'])
+archive_seconds = Histogram('rtsp_archive_seconds', 'Duration of streamed archive downloads.',
+                            buckets=(1, 5, 10, 30, 60, 300, 900, 3600))
+archive_bytes_total = Counter('rtsp_archive_bytes_total', 'Bytes sent in streamed archives.')
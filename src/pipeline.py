@@ -0,0 +1,214 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import catalog
+import metrics
+import preview
+import retention
+import storage
+import thumbnails
+from config import (ENCODE_WORKERS, ENCODE_USE_PROCESSES, ENCODE_QUEUE_SIZE, WRITE_WORKERS, WRITE_QUEUE_SIZE,
+                    PREVIEW_BUFFER_SIZE, PREVIEW_WIDTH, PREVIEW_QUALITY, DURABILITY_BATCH_SECONDS)
+
+logger = logging.getLogger('app')
+
+
+class PipelineFullError(Exception):
+    pass
+
+
+INTERPOLATIONS = {
+    'nearest': cv2.INTER_NEAREST,
+    'linear': cv2.INTER_LINEAR,
+    'area': cv2.INTER_AREA,
+    'cubic': cv2.INTER_CUBIC
+}
+
+
+class SaveTask:
+    def __init__(self, stream_name, folder, filename, timestamp, frame, extension, flags, size=None,
+                 interpolation=cv2.INTER_LINEAR):
+        self.stream_name = stream_name
+        self.folder = folder
+        self.filename = filename
+        self.timestamp = timestamp
+        self.frame = frame
+        self.extension = extension
+        self.flags = flags
+        self.size = size
+        self.interpolation = interpolation
+        self.future = Future()
+
+
+encode_queue = queue.Queue(maxsize=ENCODE_QUEUE_SIZE)
+write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+stats = {'dropped': 0, 'encoded': 0, 'written': 0, 'failed': 0}
+stats_lock = threading.Lock()
+workers = []
+workers_lock = threading.Lock()
+process_pool = None
+
+
+def encode_frame(frame, extension, flags, size=None, interpolation=cv2.INTER_LINEAR, make_preview=False):
+    # Runs in a worker thread or, with ENCODE_USE_PROCESSES, in a separate process,
+    # so stage timings are returned to the caller instead of being recorded here.
+    timings = {}
+    started = time.perf_counter()
+    if size:
+        frame = cv2.resize(frame, size, interpolation=interpolation)
+        timings['resize'] = time.perf_counter() - started
+        started = time.perf_counter()
+    ret, buffer = cv2.imencode(extension, frame, flags)
+    timings['encode'] = time.perf_counter() - started
+    started = time.perf_counter()
+    thumbnail = thumbnails.encode_thumbnail(frame)
+    timings['thumbnail'] = time.perf_counter() - started
+    data = buffer.tobytes() if ret else None
+    height, width = frame.shape[:2]
+    preview_data = None
+    if PREVIEW_BUFFER_SIZE and data is not None:
+        if extension in ('.jpg', '.jpeg') and width <= PREVIEW_WIDTH:
+            preview_data = data
+        elif make_preview:
+            started = time.perf_counter()
+            preview_data = encode_preview(frame)
+            timings['preview'] = time.perf_counter() - started
+    return data, thumbnail, width, height, preview_data, timings
+
+
+def encode_preview(frame):
+    height, width = frame.shape[:2]
+    if width > PREVIEW_WIDTH:
+        frame = cv2.resize(frame, (PREVIEW_WIDTH, max(int(height * PREVIEW_WIDTH / width), 1)),
+                           interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), PREVIEW_QUALITY])
+    return buffer.tobytes() if ret else None
+
+
+def encode_preview_from_image(data):
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return encode_preview(frame) if frame is not None else None
+
+
+def count(key):
+    with stats_lock:
+        stats[key] += 1
+
+
+def encode_worker():
+    while True:
+        task = encode_queue.get()
+        try:
+            if process_pool is not None:
+                result = process_pool.submit(encode_frame, task.frame, task.extension, task.flags, task.size,
+                                             task.interpolation, preview.is_viewed(task.stream_name)).result()
+            else:
+                result = encode_frame(task.frame, task.extension, task.flags, task.size, task.interpolation,
+                                      preview.is_viewed(task.stream_name))
+            task.frame = None
+            for stage, duration in result[5].items():
+                metrics.capture_stage_seconds.observe(duration, stage)
+            if result[0] is None:
+                count('failed')
+                metrics.capture_failures_total.inc('encode')
+                task.future.set_result(False)
+                continue
+            count('encoded')
+            preview.publish(task.stream_name, task.timestamp, result[4])
+            # Blocking here only stalls the encoders; capture keeps going until the encode queue is full.
+            write_queue.put((task, result[:4]))
+        except Exception as e:
+            count('failed')
+            metrics.capture_failures_total.inc('encode')
+            logger.error(f'Failed to encode image for "{task.stream_name}": {e}')
+            task.future.set_exception(e)
+        finally:
+            encode_queue.task_done()
+
+
+def write_worker():
+    while True:
+        try:
+            task, (data, thumbnail, width, height) = write_queue.get(timeout=DURABILITY_BATCH_SECONDS)
+        except queue.Empty:
+            # Idle folders still get their batch synced in time.
+            storage.sync_folders()
+            continue
+        try:
+            started = time.perf_counter()
+            storage.write_image(task.folder, task.filename, data)
+            metrics.capture_stage_seconds.observe(time.perf_counter() - started, 'write')
+            metrics.bytes_written_total.inc(amount=len(data))
+            metrics.captures_total.inc()
+            if thumbnail is not None:
+                thumbnails.write_thumbnail(task.stream_name, task.filename, thumbnail)
+            # Stored for archive downloads, which can then start at any offset without reading earlier images.
+            catalog.add_image(task.stream_name, task.filename, task.timestamp, len(data), width, height,
+                              zlib.crc32(data))
+            retention.record_write(task.stream_name, len(data))
+            count('written')
+            task.future.set_result(task.filename)
+        except storage.DiskSpaceError as e:
+            count('failed')
+            metrics.capture_failures_total.inc('disk')
+            retention.request_cleanup()
+            logger.error(e)
+            task.future.set_exception(e)
+        except Exception as e:
+            count('failed')
+            metrics.capture_failures_total.inc('write')
+            logger.error(f'Failed to write image "{task.filename}" for "{task.stream_name}": {e}')
+            task.future.set_exception(e)
+        finally:
+            write_queue.task_done()
+        storage.sync_folders()
+
+
+def start_workers():
+    global process_pool
+    with workers_lock:
+        if workers:
+            return
+        if ENCODE_USE_PROCESSES:
+            process_pool = ProcessPoolExecutor(max_workers=ENCODE_WORKERS)
+        for i in range(ENCODE_WORKERS):
+            workers.append(threading.Thread(target=encode_worker, name=f'encode-{i}', daemon=True))
+        for i in range(WRITE_WORKERS):
+            workers.append(threading.Thread(target=write_worker, name=f'write-{i}', daemon=True))
+        for worker in workers:
+            worker.start()
+
+
+def submit(task):
+    start_workers()
+    try:
+        encode_queue.put_nowait(task)
+    except queue.Full:
+        count('dropped')
+        metrics.capture_failures_total.inc('queue_full')
+        raise PipelineFullError('The encode queue is full, the frame was dropped. '
+                                'Stream: {}'.format(task.stream_name))
+    return task.future
+
+
+def get_pipeline_stats():
+    with stats_lock:
+        result = stats.copy()
+    result.update({
+        'encode_queue': encode_queue.qsize(),
+        'encode_queue_size': ENCODE_QUEUE_SIZE,
+        'write_queue': write_queue.qsize(),
+        'write_queue_size': WRITE_QUEUE_SIZE,
+    })
+    return result
+
+
+metrics.Gauge('rtsp_pipeline_queue_depth', 'Tasks waiting in the save pipeline queues.', ['queue'],
+              function=lambda: {('encode',): encode_queue.qsize(), ('write',): write_queue.qsize()})
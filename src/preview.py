@@ -0,0 +1,99 @@
+import collections
+import threading
+import time
+
+from config import PREVIEW_BUFFER_SIZE, PREVIEW_FPS, PREVIEW_MAX_VIEWERS, PREVIEW_DEMAND_TIMEOUT
+
+BOUNDARY = 'frame'
+# Frames are re-sent this often without new captures so disconnected viewers are noticed.
+KEEPALIVE_INTERVAL = 15  # Seconds
+
+buffers = {}
+# When each stream was last viewed, previews that cost an extra encode are only made while someone watches.
+viewed = {}
+condition = threading.Condition()
+viewers = 0
+
+
+class TooManyViewersError(Exception):
+    pass
+
+
+def publish(stream_name, timestamp, data):
+    if not PREVIEW_BUFFER_SIZE or data is None:
+        return
+    with condition:
+        buffer = buffers.get(stream_name)
+        if buffer is None:
+            buffer = buffers[stream_name] = collections.deque(maxlen=PREVIEW_BUFFER_SIZE)
+        buffer.append((timestamp, data))
+        condition.notify_all()
+
+
+def mark_viewed(stream_name):
+    viewed[stream_name] = time.monotonic()
+
+
+def is_viewed(stream_name):
+    last_viewed = viewed.get(stream_name)
+    return last_viewed is not None and last_viewed > time.monotonic() - PREVIEW_DEMAND_TIMEOUT
+
+
+def get_frame(stream_name, back=0):
+    with condition:
+        buffer = buffers.get(stream_name)
+        if not buffer or not 0 <= back < len(buffer):
+            return None
+        return buffer[-1 - back]
+
+
+def drop(stream_name):
+    with condition:
+        buffers.pop(stream_name, None)
+        viewed.pop(stream_name, None)
+        condition.notify_all()
+
+
+def get_latest(stream_name):
+    buffer = buffers.get(stream_name)
+    return buffer[-1] if buffer else None
+
+
+class MJPEGStream:
+    # Counted as a viewer from creation; the server calls close() even if the response never starts.
+    def __init__(self, stream_name, first_frame, fps):
+        self.stream_name = stream_name
+        self.first_frame = first_frame
+        self.fps = fps
+        self.closed = False
+
+    def __iter__(self):
+        sent = None
+        while True:
+            started = time.monotonic()
+            mark_viewed(self.stream_name)
+            with condition:
+                condition.wait_for(lambda: get_latest(self.stream_name) not in (None, sent),
+                                   timeout=KEEPALIVE_INTERVAL)
+                # The first frame is sent right away, so disconnects are noticed on the keepalive resend.
+                frame = get_latest(self.stream_name) or sent or self.first_frame
+            sent = frame
+            yield (f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame[1])}\r\n\r\n'
+                   .encode() + frame[1] + b'\r\n')
+            time.sleep(max(1 / self.fps - (time.monotonic() - started), 0))
+
+    def close(self):
+        global viewers
+        with condition:
+            if not self.closed:
+                self.closed = True
+                viewers -= 1
+
+
+def iter_mjpeg(stream_name, first_frame, fps=PREVIEW_FPS):
+    global viewers
+    with condition:
+        if viewers >= PREVIEW_MAX_VIEWERS:
+            raise TooManyViewersError(f'The preview is limited to {PREVIEW_MAX_VIEWERS} viewers.')
+        viewers += 1
+    return MJPEGStream(stream_name, first_frame, fps)
@@ -0,0 +1,216 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from config import RTSP_STREAMS, IMAGE_FOLDER, STATE_DB
+
+logger = logging.getLogger('app')
+
+LEGACY_STATE_FILE = 'state.json'
+
+
+def load_with_datetime(pairs):
+    d = {}
+    converters = [
+        datetime.datetime.fromisoformat,
+        datetime.date.fromisoformat,
+        datetime.time.fromisoformat
+    ]
+    for k, v in pairs:
+        if isinstance(v, str):
+            for converter in converters:
+                try:
+                    d[k] = converter(v)
+                    break
+                except ValueError:
+                    pass
+            else:
+                d[k] = v
+        else:
+            d[k] = v
+    return d
+
+
+def dump_stream(stream):
+    return json.dumps(stream, sort_keys=True,
+                      default=lambda obj: obj.isoformat() if hasattr(obj, 'isoformat') else obj)
+
+
+def load_stream(data):
+    return json.loads(data, object_pairs_hook=load_with_datetime)
+
+
+class StreamRegistry:
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.by_name = {}
+        self.by_url = {}
+        self.lock = threading.RLock()
+        self.connection = None
+        self.revision = 0
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.by_name.values()))
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def get_by_url(self, url):
+        return self.by_url.get(url)
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS streams (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+            self.connection.commit()
+        return self.connection
+
+    def get_stored_revision(self):
+        row = self.connect().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        return row[0] if row else 0
+
+    def bump_revision(self, connection):
+        # Called inside the write transaction so other processes see the change and the new revision together.
+        connection.execute("INSERT INTO meta VALUES ('revision', 1) "
+                           "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+        self.revision = connection.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def reload_if_changed(self):
+        with self.lock:
+            if self.get_stored_revision() == self.revision:
+                return False
+            self.load()
+            return True
+
+    def load(self):
+        with self.lock:
+            # The revision is read first, so a concurrent write at worst causes one extra reload later.
+            self.revision = self.get_stored_revision()
+            rows = self.connect().execute('SELECT data FROM streams').fetchall()
+            if not rows and os.path.exists(LEGACY_STATE_FILE):
+                rows = self.import_legacy_state()
+            self.by_name.clear()
+            self.by_url.clear()
+            for (data,) in rows:
+                self.index(load_stream(data))
+            for stream in RTSP_STREAMS:
+                if stream['name'] not in self.by_name:
+                    self.add(dict(stream))
+        logger.debug(f'Loaded {len(self.by_name)} streams.')
+
+    def import_legacy_state(self):
+        try:
+            with open(LEGACY_STATE_FILE, 'r') as file:
+                legacy_streams = json.load(file, object_pairs_hook=load_with_datetime)
+        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+            logger.critical('Failed to read the thread settings file. Error: {}'.format(e))
+            return []
+        rows = [(stream['name'], dump_stream(stream)) for stream in legacy_streams]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO streams VALUES (?, ?)', rows)
+            self.bump_revision(self.connection)
+        os.replace(LEGACY_STATE_FILE, LEGACY_STATE_FILE + '.bak')
+        logger.warning(f'Imported {len(rows)} streams from "{LEGACY_STATE_FILE}".')
+        return [(data,) for _, data in rows]
+
+    def index(self, stream):
+        self.by_name[stream['name']] = stream
+        self.by_url[stream['url']] = stream
+
+    def unindex(self, stream):
+        self.by_name.pop(stream['name'], None)
+        if self.by_url.get(stream['url']) is stream:
+            del self.by_url[stream['url']]
+
+    def add(self, stream):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('INSERT INTO streams VALUES (?, ?)', (stream['name'], dump_stream(stream)))
+                self.bump_revision(connection)
+            self.index(stream)
+        os.makedirs(os.path.join(IMAGE_FOLDER, stream['name']), exist_ok=True)
+        return stream
+
+    def update(self, name, data):
+        with self.lock:
+            stream = self.by_name[name]
+            updated = dict(stream, **data)
+            # INSERT OR REPLACE would silently overwrite the other stream's row.
+            for index, key in ((self.by_name, 'name'), (self.by_url, 'url')):
+                other = index.get(updated[key])
+                if other is not None and other is not stream:
+                    raise ValueError(f'This {key} "{updated[key]}" already exists.')
+            connection = self.connect()
+            with connection:
+                if updated['name'] != name:
+                    connection.execute('DELETE FROM streams WHERE name = ?', (name,))
+                connection.execute('INSERT OR REPLACE INTO streams VALUES (?, ?)',
+                                   (updated['name'], dump_stream(updated)))
+                self.bump_revision(connection)
+            # Update the dict in place so references held by scheduler jobs see the change.
+            self.unindex(stream)
+            stream.update(data)
+            self.index(stream)
+        if stream['name'] != name:
+            os.makedirs(os.path.join(IMAGE_FOLDER, stream['name']), exist_ok=True)
+        return stream
+
+    def apply_batch(self, added, updated):
+        # One transaction and one revision bump for the whole batch; updated maps names to changed fields.
+        with self.lock:
+            rows = [(stream['name'], dump_stream(stream)) for stream in added]
+            rows += [(name, dump_stream(dict(self.by_name[name], **data))) for name, data in updated.items()]
+            connection = self.connect()
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO streams VALUES (?, ?)', rows)
+                self.bump_revision(connection)
+            for stream in added:
+                self.index(stream)
+            for name, data in updated.items():
+                stream = self.by_name[name]
+                self.unindex(stream)
+                stream.update(data)
+                self.index(stream)
+        for stream in added:
+            os.makedirs(os.path.join(IMAGE_FOLDER, stream['name']), exist_ok=True)
+
+    def remove(self, name):
+        with self.lock:
+            stream = self.by_name[name]
+            connection = self.connect()
+            with connection:
+                connection.execute('DELETE FROM streams WHERE name = ?', (name,))
+                self.bump_revision(connection)
+            self.unindex(stream)
+        return stream
+
+    def heartbeat(self, worker_id, timestamp):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, timestamp))
+
+    def remove_worker(self, worker_id):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+
+    def get_workers(self, alive_since):
+        with self.lock:
+            return [row[0] for row in self.connect().execute(
+                'SELECT id FROM workers WHERE heartbeat >= ? ORDER BY id', (alive_since,))]
+
+
+streams = StreamRegistry()
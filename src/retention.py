@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+import catalog
+import storage
+import thumbnails
+from registry import streams
+from config import (IMAGE_FOLDER, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, RETENTION_MAX_AGE_DAYS,
+                    RETENTION_MAX_COUNT, RETENTION_MAX_MB, RETENTION_TOTAL_MAX_GB, RETENTION_KEEP_FREE_GB,
+                    WORKER_MODE)
+
+logger = logging.getLogger('app')
+
+usage = {}
+usage_lock = threading.Lock()
+usage_loaded = False
+cleanup_requested = threading.Event()
+retention_thread = None
+
+
+def load_usage():
+    global usage_loaded
+    stream_usage = catalog.get_usage()
+    with usage_lock:
+        usage.clear()
+        usage.update(stream_usage)
+        usage_loaded = True
+
+
+def get_usage():
+    # Worker processes write images this process never sees, so the catalog is the source of truth.
+    if not usage_loaded or WORKER_MODE:
+        load_usage()
+    with usage_lock:
+        return {name: values.copy() for name, values in usage.items()}
+
+
+def record_write(stream_name, size):
+    with usage_lock:
+        values = usage.setdefault(stream_name, {'count': 0, 'size': 0})
+        values['count'] += 1
+        values['size'] += size
+
+
+def reset_usage(stream_name):
+    with usage_lock:
+        usage.pop(stream_name, None)
+
+
+def get_policy(stream):
+    def value(key, default):
+        return stream.get(key) if stream.get(key) else default
+
+    return {
+        'max_age_days': value('retention_max_age_days', RETENTION_MAX_AGE_DAYS),
+        'max_count': value('retention_max_count', RETENTION_MAX_COUNT),
+        'max_mb': value('retention_max_mb', RETENTION_MAX_MB)
+    }
+
+
+def delete_images(images):
+    for image in images:
+        try:
+            os.unlink(thumbnails.get_thumbnail_path(image['stream'], image['filename']))
+        except OSError:
+            pass
+    catalog.delete_images(images)
+    storage.delete_images(images)
+    with usage_lock:
+        for image in images:
+            values = usage.get(image['stream'])
+            if values:
+                values['count'] -= 1
+                values['size'] -= image['size']
+    return len(images)
+
+
+def delete_oldest(stream_name=None, limit=RETENTION_BATCH_SIZE, before=None):
+    images = catalog.get_oldest_images(stream_name, limit=max(min(limit, RETENTION_BATCH_SIZE), 1), before=before)
+    return delete_images(images)
+
+
+def get_free_space_gb():
+    return shutil.disk_usage(IMAGE_FOLDER).free / 1024 ** 3
+
+
+def apply_stream_policy(stream):
+    policy = get_policy(stream)
+    name = stream['name']
+    deleted = 0
+    if policy['max_age_days']:
+        before = time.time() - policy['max_age_days'] * 24 * 3600
+        while batch := delete_oldest(name, before=before):
+            deleted += batch
+    if policy['max_count']:
+        while (excess := get_usage().get(name, {'count': 0})['count'] - policy['max_count']) > 0:
+            if not (batch := delete_oldest(name, limit=excess)):
+                break
+            deleted += batch
+    if policy['max_mb']:
+        while get_usage().get(name, {'size': 0})['size'] > policy['max_mb'] * 1024 ** 2:
+            if not (batch := delete_oldest(name, limit=RETENTION_BATCH_SIZE)):
+                break
+            deleted += batch
+    return deleted
+
+
+def apply_global_policy():
+    deleted = 0
+    if RETENTION_TOTAL_MAX_GB:
+        while sum(values['size'] for values in get_usage().values()) > RETENTION_TOTAL_MAX_GB * 1024 ** 3:
+            if not (batch := delete_oldest()):
+                break
+            deleted += batch
+    if RETENTION_KEEP_FREE_GB and os.path.isdir(IMAGE_FOLDER):
+        while get_free_space_gb() < RETENTION_KEEP_FREE_GB:
+            if not (batch := delete_oldest()):
+                break
+            deleted += batch
+    return deleted
+
+
+def apply_retention():
+    started = time.monotonic()
+    deleted = 0
+    for stream in streams:
+        deleted += apply_stream_policy(stream)
+    deleted += apply_global_policy()
+    if deleted:
+        logger.info(f'Retention deleted {deleted} images in {time.monotonic() - started:.1f} s.')
+    return deleted
+
+
+def request_cleanup():
+    cleanup_requested.set()
+
+
+def retention_loop():
+    while True:
+        cleanup_requested.wait(RETENTION_INTERVAL * 60)
+        cleanup_requested.clear()
+        try:
+            apply_retention()
+        except Exception as e:
+            logger.error(f'Retention failed: {e}')
+
+
+def start():
+    global retention_thread
+    if retention_thread is None:
+        load_usage()
+        retention_thread = threading.Thread(target=retention_loop, name='retention', daemon=True)
+        retention_thread.start()
+        request_cleanup()
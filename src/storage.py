@@ -0,0 +1,332 @@
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+
+import pytz
+
+import catalog
+from config import (IMAGE_FOLDER, TIMEZONE, STORAGE_SHARD_BY_DATE, DISK_RESERVE_MB, DURABILITY,
+                    DURABILITY_BATCH_FILES, DURABILITY_BATCH_SECONDS)
+
+logger = logging.getLogger('app')
+
+DATE_PATTERN = re.compile(r'_(\d{4})-(\d{2})-(\d{2})_\d{2}-\d{2}-\d{2}\.\w+$')
+PACK_EXTENSION = '.pack'
+INDEX_EXTENSION = '.idx'
+
+# Folder -> (first write time, paths written since the last sync), used by the 'batch' durability policy.
+unsynced = {}
+unsynced_lock = threading.Lock()
+# Packing appends to the segment of a day that compaction may be replacing.
+pack_lock = threading.Lock()
+
+
+class DiskSpaceError(Exception):
+    pass
+
+
+def get_day(filename):
+    match = DATE_PATTERN.search(filename)
+    return match.groups() if match else None
+
+
+def get_image_folder(stream_name, filename):
+    day = get_day(filename) if STORAGE_SHARD_BY_DATE else None
+    if day is None:
+        return os.path.join(IMAGE_FOLDER, stream_name)
+    return os.path.join(IMAGE_FOLDER, stream_name, *day)
+
+
+def get_image_path(stream_name, filename):
+    # Files saved before sharding or with an unexpected name stay in the flat stream folder.
+    path = os.path.join(get_image_folder(stream_name, filename), filename)
+    if os.path.exists(path):
+        return path
+    flat_path = os.path.join(IMAGE_FOLDER, stream_name, filename)
+    if os.path.exists(flat_path):
+        return flat_path
+    return None
+
+
+def fsync_path(path, flags=os.O_RDONLY):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_folder(folder):
+    # Makes the rename itself durable; directories can't be opened for syncing on Windows.
+    if os.name == 'posix':
+        fsync_path(folder)
+
+
+def write_file(path, data, sync=False):
+    temp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_image(folder, filename, data):
+    os.makedirs(folder, exist_ok=True)
+    # The encoded size is known, so the check is exact instead of a fixed threshold.
+    free = shutil.disk_usage(folder).free
+    if free - len(data) < DISK_RESERVE_MB * 1024 ** 2:
+        raise DiskSpaceError(f'Not enough disk space available to save "{filename}", '
+                             f'{free / 1024 ** 2:.0f} MB free, {DISK_RESERVE_MB} MB reserved.')
+    path = os.path.join(folder, filename)
+    write_file(path, data, sync=DURABILITY == 'file')
+    if DURABILITY == 'file':
+        fsync_folder(folder)
+    elif DURABILITY == 'batch':
+        with unsynced_lock:
+            started, paths = unsynced.setdefault(folder, (time.monotonic(), []))
+            paths.append(path)
+        if len(paths) >= DURABILITY_BATCH_FILES:
+            sync_folders(force=True, folders=[folder])
+    return path
+
+
+def sync_folders(force=False, folders=None):
+    now = time.monotonic()
+    with unsynced_lock:
+        due = [folder for folder in (folders or list(unsynced)) if folder in unsynced and
+               (force or unsynced[folder][0] <= now - DURABILITY_BATCH_SECONDS)]
+        batches = [(folder, unsynced.pop(folder)[1]) for folder in due]
+    for folder, paths in batches:
+        for path in paths:
+            try:
+                fsync_path(path, os.O_RDWR)
+            except FileNotFoundError:
+                pass
+        fsync_folder(folder)
+    return sum(len(paths) for _, paths in batches)
+
+
+def read_packed(image):
+    with open(image['pack'], 'rb') as file:
+        file.seek(image['offset'])
+        data = file.read(image['size'])
+    if len(data) != image['size']:
+        raise OSError(f'Segment "{image["pack"]}" is truncated.')
+    return data
+
+
+def open_image(stream_name, filename):
+    # A day can be packed between the catalog lookup and the open, so look the image up once more.
+    for _ in range(2):
+        image = catalog.get_image(stream_name, filename)
+        try:
+            if image is not None and image['pack']:
+                return io.BytesIO(read_packed(image))
+            path = get_image_path(stream_name, filename)
+            if path is not None:
+                return open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        if image is None:
+            break
+    raise FileNotFoundError(f'Image "{filename}" of "{stream_name}" not found.')
+
+
+def read_image(stream_name, filename):
+    with open_image(stream_name, filename) as file:
+        return file.read()
+
+
+def delete_images(images):
+    # The catalog rows of packed images are already gone, their segments are compacted afterwards.
+    folders = set()
+    packs = set()
+    for image in images:
+        if image['pack']:
+            packs.add(image['pack'])
+            continue
+        path = get_image_path(image['stream'], image['filename'])
+        if path is None:
+            continue
+        try:
+            os.unlink(path)
+            folders.add(os.path.dirname(path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f'Failed to delete "{image["filename"]}" of "{image["stream"]}": {e}')
+    for pack in packs:
+        # Rewritten without the deleted images, so their space is freed and rebuild can't bring them back.
+        compact_pack(pack)
+        folders.add(os.path.dirname(pack))
+    for folder in folders:
+        remove_empty_folders(folder)
+
+
+def remove_empty_folders(folder):
+    root = os.path.abspath(IMAGE_FOLDER)
+    folder = os.path.abspath(folder)
+    # Stop at the stream folder itself.
+    while os.path.dirname(folder) != root and folder.startswith(root + os.sep):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break
+        folder = os.path.dirname(folder)
+
+
+def delete_pack(pack):
+    # The index goes first, so an interrupted delete never leaves entries that rebuild would restore.
+    for path in (pack[:-len(PACK_EXTENSION)] + INDEX_EXTENSION, pack):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def compact_pack(pack):
+    # The remaining images go to a segment with a new name, so readers of the old one keep working until
+    # the catalog points at the new one.
+    with pack_lock:
+        images = catalog.get_pack_images(pack)
+        if not images:
+            delete_pack(pack)
+            return 0
+        base = os.path.join(os.path.dirname(pack), os.path.basename(pack).split('.')[0] + f'.{time.time_ns()}')
+        new_pack = base + PACK_EXTENSION
+        entries = []
+        with open(new_pack, 'wb') as segment, open(base + INDEX_EXTENSION, 'w') as index:
+            for image in images:
+                data = read_packed(image)
+                offset = segment.tell()
+                segment.write(data)
+                crc = image['crc'] if image['crc'] is not None else zlib.crc32(data)
+                index.write(json.dumps({'filename': image['filename'], 'offset': offset, 'size': len(data),
+                                        'timestamp': image['timestamp'], 'crc': crc}) + '\n')
+                entries.append((image['filename'], new_pack, offset, crc))
+            segment.flush()
+            os.fsync(segment.fileno())
+            index.flush()
+            os.fsync(index.fileno())
+        fsync_folder(os.path.dirname(new_pack))
+        catalog.set_packed(images[0]['stream'], entries)
+        delete_pack(pack)
+    return len(entries)
+
+
+def pack_day(stream_name, day, images):
+    # Append-only: the segment and its index are flushed before the catalog points at them,
+    # and loose files are removed last, so an interrupted run leaves every image readable.
+    base = os.path.join(IMAGE_FOLDER, stream_name, day[0], day[1], day[2])
+    pack = base + PACK_EXTENSION
+    os.makedirs(os.path.dirname(pack), exist_ok=True)
+    entries = []
+    paths = []
+    with pack_lock:
+        with open(pack, 'ab') as segment, open(base + INDEX_EXTENSION, 'a') as index:
+            for image in images:
+                path = get_image_path(stream_name, image['filename'])
+                if path is None:
+                    continue
+                with open(path, 'rb') as file:
+                    data = file.read()
+                offset = segment.tell()
+                segment.write(data)
+                crc = image['crc'] if image['crc'] is not None else zlib.crc32(data)
+                index.write(json.dumps({'filename': image['filename'], 'offset': offset, 'size': len(data),
+                                        'timestamp': image['timestamp'], 'crc': crc}) + '\n')
+                entries.append((image['filename'], pack, offset, crc))
+                paths.append(path)
+            segment.flush()
+            os.fsync(segment.fileno())
+            index.flush()
+            os.fsync(index.fileno())
+        catalog.set_packed(stream_name, entries)
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    if paths:
+        remove_empty_folders(os.path.dirname(paths[0]))
+    return len(entries)
+
+
+def pack_closed_days(stream_names=None, batch_size=1000):
+    timezone = pytz.timezone(TIMEZONE)
+    midnight = datetime.datetime.now(timezone).replace(hour=0, minute=0, second=0, microsecond=0)
+    if stream_names is None:
+        stream_names = list(catalog.get_usage())
+    packed = 0
+    for stream_name in stream_names:
+        while images := catalog.get_unpacked_images(stream_name, midnight.timestamp(), batch_size):
+            days = {}
+            for image in images:
+                day = get_day(image['filename'])
+                if day is None:
+                    # Files with an unexpected name can't be assigned to a segment and stay loose.
+                    day = tuple(datetime.datetime.fromtimestamp(image['timestamp'], timezone).strftime('%Y %m %d')
+                                .split())
+                days.setdefault(day, []).append(image)
+            count = sum(pack_day(stream_name, day, day_images) for day, day_images in days.items())
+            packed += count
+            if not count:
+                break
+    if packed:
+        logger.info(f'Packed {packed} images of closed days.')
+    return packed
+
+
+def migrate(stream_name):
+    # Moves files from the flat <stream>/<file> layout into date folders, the catalog only keeps file names.
+    folder = os.path.join(IMAGE_FOLDER, stream_name)
+    moved = 0
+    if not os.path.isdir(folder):
+        return moved
+    for entry in os.scandir(folder):
+        if not entry.is_file():
+            continue
+        target_folder = get_image_folder(stream_name, entry.name)
+        if target_folder == folder:
+            continue
+        os.makedirs(target_folder, exist_ok=True)
+        os.replace(entry.path, os.path.join(target_folder, entry.name))
+        moved += 1
+    logger.info(f'Moved {moved} images of "{stream_name}" into date folders.')
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the image storage layout.')
+    parser.add_argument('command', choices=['migrate', 'pack'],
+                        help='"migrate" moves flat folders into date folders, "pack" packs closed days.')
+    parser.add_argument('streams', nargs='*', help='Stream names, all streams by default.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    stream_names = args.streams
+    if not stream_names and os.path.isdir(IMAGE_FOLDER):
+        stream_names = [entry.name for entry in os.scandir(IMAGE_FOLDER) if entry.is_dir()]
+    if args.command == 'migrate':
+        if not STORAGE_SHARD_BY_DATE:
+            parser.error('STORAGE_SHARD_BY_DATE is disabled.')
+        for name in stream_names:
+            migrate(name)
+    else:
+        pack_closed_days(stream_names)
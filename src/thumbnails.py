@@ -0,0 +1,78 @@
+import logging
+import os
+import shutil
+
+import cv2
+from PIL import Image
+
+import storage
+from config import THUMBNAIL_FOLDER, THUMBNAIL_SIZE, THUMBNAIL_QUALITY, THUMBNAIL_CACHE_MAX_MB
+
+logger = logging.getLogger('app')
+
+
+def get_thumbnail_path(stream_name, filename):
+    return os.path.join(THUMBNAIL_FOLDER, stream_name, os.path.splitext(filename)[0] + '.jpg')
+
+
+def encode_thumbnail(frame):
+    height, width = frame.shape[:2]
+    scale = min(THUMBNAIL_SIZE[0] / width, THUMBNAIL_SIZE[1] / height, 1)
+    small = cv2.resize(frame, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                       interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', small, [int(cv2.IMWRITE_JPEG_QUALITY), THUMBNAIL_QUALITY])
+    return buffer.tobytes() if ret else None
+
+
+def write_thumbnail(stream_name, filename, data):
+    path = get_thumbnail_path(stream_name, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    storage.write_file(path, data)
+
+
+def create_thumbnail(stream_name, filename, source):
+    path = get_thumbnail_path(stream_name, filename)
+    with Image.open(source) as image:
+        if image.format == 'JPEG':
+            # Let the JPEG decoder scale down by a power of two instead of decoding the full frame.
+            image.draft('RGB', THUMBNAIL_SIZE)
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image.save(path, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return path
+
+
+def delete_thumbnails(stream_name):
+    shutil.rmtree(os.path.join(THUMBNAIL_FOLDER, stream_name), ignore_errors=True)
+
+
+def evict_thumbnails():
+    entries = []
+    total_size = 0
+    if not os.path.isdir(THUMBNAIL_FOLDER):
+        return 0
+    for stream_folder in os.scandir(THUMBNAIL_FOLDER):
+        if not stream_folder.is_dir():
+            continue
+        for entry in os.scandir(stream_folder.path):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    limit = THUMBNAIL_CACHE_MAX_MB * 1024 ** 2
+    if total_size <= limit:
+        return 0
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total_size <= limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total_size -= size
+        removed += 1
+    logger.info(f'Evicted {removed} thumbnails from the cache.')
+    return removed
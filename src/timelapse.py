@@ -0,0 +1,223 @@
+import datetime
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytz
+
+import catalog
+import storage
+from config import (TIMEZONE, TIMELAPSE_FOLDER, TIMELAPSE_FPS, TIMELAPSE_WIDTH, TIMELAPSE_FOURCC,
+                    TIMELAPSE_WORKERS, TIMELAPSE_EXPORT_TTL)
+
+logger = logging.getLogger('app')
+
+jobs = {}
+jobs_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=TIMELAPSE_WORKERS, thread_name_prefix='timelapse')
+
+
+def get_day_bounds(day):
+    tz = pytz.timezone(TIMEZONE)
+    start = tz.localize(datetime.datetime.combine(day, datetime.time()))
+    end = tz.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()))
+    return start.timestamp(), end.timestamp()
+
+
+def get_frame_size(stream_name, start, end, width):
+    first = catalog.list_images(stream_name, start=start, end=end, limit=1).fetchone()
+    if first is None:
+        return None
+    if first['width'] and first['height']:
+        source_width, source_height = first['width'], first['height']
+    else:
+        frame = decode_image(stream_name, first['filename'], cv2.IMREAD_COLOR)
+        if frame is None:
+            return None
+        source_height, source_width = frame.shape[:2]
+    width = min(width, source_width)
+    height = int(source_height * width / source_width)
+    # Most codecs require even dimensions.
+    return width - width % 2, height - height % 2
+
+
+def decode_image(stream_name, filename, flag):
+    try:
+        data = storage.read_image(stream_name, filename)
+    except OSError:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+
+
+def read_frame(stream_name, image, size):
+    # Let the decoder downscale by 2, 4 or 8 when the source is much larger than the video.
+    flag = cv2.IMREAD_COLOR
+    if image['width']:
+        ratio = image['width'] / size[0]
+        if ratio >= 8:
+            flag = cv2.IMREAD_REDUCED_COLOR_8
+        elif ratio >= 4:
+            flag = cv2.IMREAD_REDUCED_COLOR_4
+        elif ratio >= 2:
+            flag = cv2.IMREAD_REDUCED_COLOR_2
+    frame = decode_image(stream_name, image['filename'], flag)
+    if frame is not None and (frame.shape[1], frame.shape[0]) != size:
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def open_writer(path, fps, size):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*TIMELAPSE_FOURCC), fps, size)
+    if not writer.isOpened():
+        raise OSError(f'Failed to open a video writer for "{path}".')
+    return writer
+
+
+def build_segment(job, day, size):
+    stream_name = job['stream']
+    start, end = get_day_bounds(day)
+    count = catalog.count_images(stream_name, start, end)
+    folder = os.path.join(TIMELAPSE_FOLDER, stream_name)
+    prefix = f'{day.isoformat()}_{size[0]}x{size[1]}_{job["fps"]}fps'
+    path = os.path.join(folder, f'{prefix}_{count}.mp4')
+    if os.path.exists(path):
+        job['done'] += count
+        return path, count
+    if not count:
+        return None, 0
+    os.makedirs(folder, exist_ok=True)
+    temp_path = os.path.join(folder, f'tmp_{prefix}_{count}.mp4')
+    writer = open_writer(temp_path, job['fps'], size)
+    try:
+        for image in catalog.list_images(stream_name, start=start, end=end):
+            frame = read_frame(stream_name, image, size)
+            if frame is not None:
+                writer.write(frame)
+            job['done'] += 1
+    finally:
+        writer.release()
+    # Segments of the same day built from fewer frames are outdated now.
+    for outdated in glob.glob(os.path.join(folder, glob.escape(prefix) + '_*.mp4')):
+        os.unlink(outdated)
+    os.replace(temp_path, path)
+    return path, count
+
+
+def concatenate(job, paths, output, fps, size):
+    writer = open_writer(output, fps, size)
+    try:
+        for path in paths:
+            cap = cv2.VideoCapture(path)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                writer.write(frame)
+                job['joined'] += 1
+            cap.release()
+    finally:
+        writer.release()
+
+
+def export(job, segments, size):
+    # Exports are cached by their segments: segment names change with the frames of their day,
+    # so an unchanged period is served again without decoding and encoding the video.
+    export_folder = os.path.join(TIMELAPSE_FOLDER, 'exports')
+    os.makedirs(export_folder, exist_ok=True)
+    key = hashlib.sha1('|'.join(segments).encode()).hexdigest()
+    output = os.path.join(export_folder, f'{key}.mp4')
+    if os.path.exists(output):
+        # Restarts the TTL of a cached export.
+        os.utime(output)
+        return output
+    temp_path = os.path.join(export_folder, f'tmp_{job["id"]}.mp4')
+    try:
+        if len(segments) == 1:
+            # A single day is the segment itself, copied so it isn't encoded a second time.
+            shutil.copyfile(segments[0], temp_path)
+        else:
+            job.update({'phase': 'joining', 'join_total': job['total']})
+            concatenate(job, segments, temp_path, job['fps'], size)
+        os.replace(temp_path, output)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    return output
+
+
+def delete_segments(stream_name):
+    shutil.rmtree(os.path.join(TIMELAPSE_FOLDER, stream_name), ignore_errors=True)
+
+
+def delete_old_exports():
+    folder = os.path.join(TIMELAPSE_FOLDER, 'exports')
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        if entry.stat().st_mtime < time.time() - TIMELAPSE_EXPORT_TTL * 3600:
+            os.unlink(entry.path)
+
+
+def run_job(job):
+    try:
+        job['status'] = 'running'
+        delete_old_exports()
+        start, _ = get_day_bounds(job['start_date'])
+        _, end = get_day_bounds(job['end_date'])
+        job['total'] = catalog.count_images(job['stream'], start, end)
+        size = get_frame_size(job['stream'], start, end, job['width'])
+        if size is None:
+            raise ValueError('There are no images in the selected period.')
+        segments = []
+        day = job['start_date']
+        while day <= job['end_date']:
+            path, count = build_segment(job, day, size)
+            if path:
+                segments.append(path)
+            day += datetime.timedelta(days=1)
+        if not segments:
+            raise ValueError('There are no images in the selected period.')
+        job.update({'status': 'done', 'path': export(job, segments, size), 'done': job['total']})
+        logger.info(f'Time-lapse for "{job["stream"]}" from {job["start_date"]} to {job["end_date"]} created.')
+    except Exception as e:
+        job.update({'status': 'failed', 'error': str(e)})
+        logger.error(f'Time-lapse for "{job["stream"]}" failed: {e}')
+
+
+def start_job(stream_name, start_date, end_date, fps=TIMELAPSE_FPS, width=TIMELAPSE_WIDTH):
+    job = {
+        'id': uuid.uuid4().hex,
+        'stream': stream_name,
+        'start_date': start_date,
+        'end_date': end_date,
+        'fps': fps,
+        'width': width,
+        'status': 'queued',
+        'done': 0,
+        'total': None,
+        'phase': 'frames',
+        'joined': 0,
+        'join_total': None,
+        'path': None,
+        'error': None,
+        'created': time.time()
+    }
+    with jobs_lock:
+        for job_id in [job_id for job_id, old_job in jobs.items()
+                       if old_job['created'] < time.time() - TIMELAPSE_EXPORT_TTL * 3600]:
+            del jobs[job_id]
+        jobs[job['id']] = job
+    executor.submit(run_job, job)
+    return job
+
+
+def get_job(job_id):
+    return jobs.get(job_id)
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import zlib
+
+import alerts
+from capture import close_all_sessions, check_capture_options
+from config import WORKER_HEARTBEAT_INTERVAL, WORKER_TIMEOUT
+from functions import create_scheduler, sync_scheduler
+from registry import streams
+
+logger = logging.getLogger('app')
+
+
+def get_owner(stream_name, workers):
+    # Rendezvous hashing: when a worker leaves, only its own streams move to other workers.
+    return max(workers, key=lambda worker_id: zlib.crc32(f'{worker_id}/{stream_name}'.encode()))
+
+
+def get_shard(worker_id, workers):
+    return [stream for stream in streams if get_owner(stream['name'], workers) == worker_id]
+
+
+def run(worker_id):
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    scheduler = create_scheduler()
+    scheduler.start()
+    scheduled = {}
+    workers = []
+    streams.load()
+    check_capture_options(streams)
+    logger.warning(f'Worker "{worker_id}" is running.')
+    try:
+        while not stopped.is_set():
+            now = time.time()
+            streams.heartbeat(worker_id, now)
+            streams.reload_if_changed()
+            live_workers = streams.get_workers(now - WORKER_TIMEOUT)
+            if live_workers != workers:
+                workers = live_workers
+                logger.info(f'Worker "{worker_id}": {len(workers)} live workers.')
+            shard = get_shard(worker_id, workers)
+            sync_scheduler(scheduler, shard, scheduled)
+            stopped.wait(WORKER_HEARTBEAT_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Leave the worker table right away so the remaining workers take over this shard.
+        streams.remove_worker(worker_id)
+        scheduler.shutdown(wait=False)
+        close_all_sessions()
+        logger.warning(f'Worker "{worker_id}" stopped.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run capture jobs for a shard of the configured streams.')
+    parser.add_argument('--id', default=f'{socket.gethostname()}-{os.getpid()}', help='Unique worker id.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    alerts.setup_logging([logging.getLogger('app'), logging.getLogger('apscheduler')], [])
+    run(args.id)
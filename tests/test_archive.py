@@ -0,0 +1,124 @@
+import io
+import os
+import sys
+import zipfile
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from archive import ZipArchive  # noqa: E402
+
+
+class SparseFile(io.RawIOBase):
+    # Serves the bytes of one range of an archive and zeros elsewhere, so huge layouts can be read by zipfile.
+    def __init__(self, size, start, data):
+        super().__init__()
+        self.size = size
+        self.start = start
+        self.data = data
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        result = bytearray(max(end - self.position, 0))
+        low, high = max(self.position, self.start), min(end, self.start + len(self.data))
+        if low < high:
+            result[low - self.position:high - self.position] = self.data[low - self.start:high - self.start]
+        self.position = end
+        return bytes(result)
+
+
+def make_archive(files, with_crc=True):
+    opened = []
+
+    def list_entries():
+        for name, data in files:
+            def open_function(name=name, data=data):
+                opened.append(name)
+                return io.BytesIO(data)
+            yield name, 1700000000, len(data), zlib.crc32(data) if with_crc else None, open_function
+
+    archive = ZipArchive(len(files), sum(len(data) for _, data in files),
+                         sum(len(name.encode()) for name, _ in files), list_entries)
+    return archive, opened
+
+
+def sample_files(count=20):
+    return [(f'cam_{i:03d}.jpg', os.urandom(100 + i * 37)) for i in range(count)] + [('café.png', b'\x89PNG' * 9)]
+
+
+def test_full_archive():
+    files = sample_files()
+    archive, _ = make_archive(files)
+    data = b''.join(archive.iter_bytes())
+    assert len(data) == archive.size
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert zipf.testzip() is None
+        assert [(info.filename, zipf.read(info)) for info in zipf.infolist()] == files
+
+
+def test_full_archive_without_stored_crc():
+    files = sample_files(3)
+    archive, _ = make_archive(files, with_crc=False)
+    with zipfile.ZipFile(io.BytesIO(b''.join(archive.iter_bytes()))) as zipf:
+        assert zipf.testzip() is None
+
+
+def test_ranges_match_full_archive():
+    files = sample_files()
+    archive, _ = make_archive(files)
+    data = b''.join(archive.iter_bytes())
+    for start, stop in [(0, 1), (0, 30), (100, 2000), (1000, archive.central_offset + 10),
+                        (archive.central_offset - 5, archive.size), (archive.size - 22, archive.size),
+                        (archive.size - 1, archive.size)]:
+        assert b''.join(archive.iter_bytes(start, stop)) == data[start:stop]
+
+
+def test_range_reads_only_covered_entries():
+    files = sample_files()
+    archive, opened = make_archive(files)
+    b''.join(archive.iter_bytes(archive.central_offset - 10))
+    assert opened == [files[-1][0]]
+
+
+def test_zip64_entry_count():
+    files = [(f'{i}.jpg', b'abc') for i in range(70000)]
+    archive, _ = make_archive(files)
+    assert archive.zip64
+    data = b''.join(archive.iter_bytes())
+    assert len(data) == archive.size
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert len(zipf.infolist()) == 70000
+        assert zipf.read('69999.jpg') == b'abc'
+
+
+def test_zip64_offsets():
+    size = 1024 ** 3
+    names = [f'{i}.jpg' for i in range(6)]
+
+    def list_entries():
+        for name in names:
+            yield name, 1700000000, size, 1, lambda: io.BytesIO(b'')
+
+    archive = ZipArchive(len(names), size * len(names), sum(len(name) for name in names), list_entries)
+    assert archive.zip64_offsets
+    tail = b''.join(archive.iter_bytes(archive.central_offset))
+    assert len(tail) == archive.size - archive.central_offset
+    with zipfile.ZipFile(SparseFile(archive.size, archive.central_offset, tail)) as zipf:
+        infos = zipf.infolist()
+    assert [info.filename for info in infos] == names
+    assert [info.header_offset for info in infos] == [i * (30 + 5 + size) for i in range(6)]
+    assert all(info.file_size == size for info in infos)